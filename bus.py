@@ -3,42 +3,415 @@
 """The bus class connects the different classes together"""
 
 import abc
+import heapq
+import itertools
+
+PAGE_SIZE = 0x100
+PAGE_COUNT = 0x100
+NEVER = float('inf')    # Cycle stamp of an event that is never due
+DIRTY_ALL = 0xFF        # Dirty page bitmap value for a written page: every consumer's bit set
+
+
+class _Unmapped:
+    """Stands in for a device wherever nothing is mapped on the bus"""
+    read_buffer = None
+    write_buffer = None
+    dirty_pages = None
+
+    def __getitem__(self, address):
+        raise IndexError(address)
+
+    def __setitem__(self, address, data):
+        raise IndexError(address)
+
+
+_UNMAPPED = _Unmapped()
+
+
+class _OpenBus:
+    """Stands in for a device wherever nothing is mapped on a bus with an open bus value. Reads return the
+    value and writes are lost, both through plain page buffers so they cost no more than RAM accesses"""
+    dirty_pages = None
+
+    def __init__(self, value):
+        self.value = value
+        self.read_buffer = bytes((value,)) * PAGE_SIZE
+        self.write_buffer = bytearray(PAGE_SIZE)    # Scratch page shared by every unmapped page
+
+    def __getitem__(self, address):
+        return self.value
+
+    def __setitem__(self, address, data):
+        pass
+
+
+class _DevicePage:
+    """Forwards accesses within one page to a device that has no directly indexable buffer"""
+
+    def __init__(self, device, offset):
+        self.device = device
+        self.offset = offset
+
+    def __getitem__(self, index):
+        return self.device[index - self.offset]
+
+    def __setitem__(self, index, data):
+        self.device[index - self.offset] = data
+
+
+class _DirtyPage:
+    """Write page into a device buffer that also marks the device's dirty page bitmap"""
+
+    def __init__(self, view, dirty, start):
+        self.view = view
+        self.dirty = dirty
+        self.start = start
+
+    def __setitem__(self, index, data):
+        self.view[index] = data
+        self.dirty[(self.start + index) >> 8] = DIRTY_ALL
+
+
+class _WatchedPage:
+    """Write page that reports every write to its (callback, page, exact) watchers. Through a mirror those
+    are the watchers of every page showing the same memory, given index None where a mask hides which of
+    their bytes changed. A callback that stops watching its page on the way is not called for it"""
+
+    def __init__(self, bus, calls, target):
+        self.bus = bus
+        self.calls = calls
+        self.target = target
+
+    def __setitem__(self, index, data):
+        self.target[index] = data
+        watchers = self.bus._watchers
+        for callback, page, exact in self.calls:
+            if callback in watchers[page]:
+                callback(page, index if exact else None)
+
+
+class _MirrorPage:
+    """Page showing another page with the low address bits masked, for mirrors repeating within a page"""
+
+    def __init__(self, target, mask):
+        self.target = target
+        self.mask = mask
+
+    def __getitem__(self, index):
+        return self.target[index & self.mask]
+
+    def __setitem__(self, index, data):
+        self.target[index & self.mask] = data
+
+
+class _SubPage:
+    """Splits a single page between devices that do not fill it completely"""
+
+    def __init__(self, base, device, offset):
+        self.base = base
+        self.entries = [(device, offset - base)] * PAGE_SIZE
+
+    def __getitem__(self, index):
+        device, offset = self.entries[index]
+        return device[index - offset]
+
+    def __setitem__(self, index, data):
+        device, offset = self.entries[index]
+        device[index - offset] = data
 
 
 class Bus:
-    """Basic bus class with interrupt support"""
+    """Basic bus class with interrupt support. Without an open_bus value, accessing an address where nothing
+    is mapped raises IndexError; with one, reads there return the value and writes are ignored"""
 
-    def __init__(self):
+    def __init__(self, open_bus=None):
         self.mapping = dict()
+        self.mirrors = dict()   # Range to the mask its addresses are decoded with, see mirror()
         self.cpu = None
+        self._unmapped = _UNMAPPED if open_bus is None else _OpenBus(open_bus)
+        # One (device, offset) entry per 256 byte page so decoding is a single index
+        self._pages = [(self._unmapped, page << 8) for page in range(PAGE_COUNT)]
+        # Objects indexed by the low address byte: views straight into RAM/ROM buffers where possible,
+        # device dispatch otherwise. Updated in place so callers may hold on to the lists.
+        self.read_pages = [None] * PAGE_COUNT
+        self.write_pages = [None] * PAGE_COUNT
+        self._write_targets = [None] * PAGE_COUNT   # Write pages before any watch is applied
+        self._watchers = [()] * PAGE_COUNT
+        self._aliases = [(page,) for page in range(PAGE_COUNT)]  # Pages showing the same memory as each page
+        self._exact = [True] * PAGE_COUNT       # False where a mirror masks bits within the page
+        self._mirrored_devices = set()          # Devices with a page that mirrors show elsewhere
+        self._device_pages = dict()     # Device to the pages it fills completely, for rebase()
+        self._split_devices = set()     # Devices sharing a page with another device
+        self._rebased = dict()          # (device, offset of its first page) to the pages built by rebase()
+        self._events = []   # Heap of [cycle, sequence, callback]
+        self._sequence = itertools.count()
+        self.next_event = NEVER
+        self._build_pages()
 
     def __getitem__(self, address):
         if not isinstance(address, range):
-            for key in self.mapping:
-                if address in key:
-                    mapping, offset = self.mapping[key]
-                    return mapping[address - offset]
-            raise IndexError(address)
+            if address < 0:
+                raise IndexError(address)
+            return self.read_pages[address >> 8][address & 0xFF]
         else:
             return self.mapping[address]
 
     def __setitem__(self, address, data):
         if not isinstance(address, range):
-            for key in self.mapping:
-                if address in key:
-                    mapping, offset = self.mapping[key]
-                    mapping[address - offset] = data
-                    return
-            raise IndexError(address)
+            if address < 0:
+                raise IndexError(address)
+            self.write_pages[address >> 8][address & 0xFF] = data
         else:
             self.mapping[address] = data
+            self._build_pages()
 
     def register(self, device, min_address):
         if device.absolute_address:
             offset = min_address
         else:
             offset = 0
-        self.mapping[range(min_address, min_address + device.size)] = (device, offset)
+        self[range(min_address, min_address + device.size)] = (device, offset)
+
+    def mirror(self, addresses, mask):
+        """Decodes every address in the range as address & mask, so whatever is mapped there repeats across
+        the range, e.g. mirror(range(0x0000, 0x2000), 0x07FF) for 2K of RAM on 8K of address space. Each page
+        resolves to its target once here, leaving a single mask at access time for mirrors within a page.
+        The range has to start and stop on page boundaries"""
+        if addresses.start % PAGE_SIZE or addresses.stop % PAGE_SIZE:
+            raise ValueError(f'{addresses} does not start and stop on page boundaries')
+        self.mirrors[addresses] = mask
+        self._build_pages()
+
+    def invalidate(self, device, start, stop):
+        """Tells the watchers of every page showing device[start:stop] that it was remapped, for devices that
+        change their contents without going through the write pages"""
+        pages = set()
+        for page, (mapped, offset) in enumerate(self._pages):
+            if isinstance(mapped, _SubPage):
+                hit = any(entry is device for entry, _ in mapped.entries)
+            else:
+                first = (page << 8) - offset
+                hit = mapped is device and first < stop and start < first + PAGE_SIZE
+            if hit:
+                pages.update(self._aliases[page])
+        for page in sorted(pages):
+            for callback in self._watchers[page]:
+                callback(page, None)
+
+    def mapped(self, address):
+        """True if a device answers at address rather than the open bus or nothing"""
+        device, _ = self._pages[address >> 8]
+        if isinstance(device, _SubPage):
+            device, _ = device.entries[address & 0xFF]
+        return device is not self._unmapped
+
+    def unregister(self, device):
+        """Removes every range the device is mapped at"""
+        for key in [key for key, (mapped, _) in self.mapping.items() if mapped is device]:
+            del self.mapping[key]
+        self._build_pages()
+
+    def rebase(self, device, shift):
+        """Makes the device's pages show its contents shift bytes further on, as if its offset had been
+        lowered by shift. Only the pages of that device are repointed, so a bank switch costs no more than
+        the pages in its window"""
+        for key, (mapped, offset) in self.mapping.items():
+            if mapped is device:
+                self.mapping[key] = (device, offset - shift)
+        if device in self._split_devices or device in self._mirrored_devices:
+            self._build_pages()
+            return
+        pages = self._device_pages.get(device)
+        if not pages:
+            return
+        # Offsets within a device move together, so its first page identifies the whole set of pages
+        key = (device, self._pages[pages[0]][1] - shift)
+        if key not in self._rebased:
+            for page in pages:
+                self._pages[page] = (device, self._pages[page][1] - shift)
+                self._set_page(page, *self._pages[page])
+            self._rebased[key] = ([self._pages[page] for page in pages], [self.read_pages[page] for page in pages],
+                                  [self._write_targets[page] for page in pages])
+        entries, reads, writes = self._rebased[key]
+        if isinstance(pages, range):
+            self._pages[pages.start:pages.stop] = entries
+            self.read_pages[pages.start:pages.stop] = reads
+            self._write_targets[pages.start:pages.stop] = writes
+            self.write_pages[pages.start:pages.stop] = writes
+        else:
+            for page, entry, read, write in zip(pages, entries, reads, writes):
+                self._pages[page] = entry
+                self.read_pages[page] = read
+                self._write_targets[page] = self.write_pages[page] = write
+        for page in pages:
+            if self._watchers[page]:
+                self._apply_watch(page)
+                for callback in self._watchers[page]:
+                    callback(page, None)
+
+    def _build_pages(self):
+        """Rebuilds the page table from the mapping, earlier registrations taking priority"""
+        self._pages = [(self._unmapped, page << 8) for page in range(PAGE_COUNT)]
+        self._split_devices = set()
+        self._rebased = dict()
+        for key, (device, offset) in reversed(self.mapping.items()):
+            self._map(key, device, offset)
+        for page, (device, offset) in enumerate(self._pages):
+            if isinstance(device, _SubPage):
+                self.read_pages[page] = self._write_targets[page] = device
+            else:
+                self._set_page(page, device, offset)
+        mirrored = self._apply_mirrors()
+        self._device_pages = dict()
+        for page, (device, offset) in enumerate(self._pages):
+            if page not in mirrored and not isinstance(device, _SubPage):
+                self._device_pages.setdefault(device, []).append(page)
+        for device, pages in self._device_pages.items():
+            if pages[-1] - pages[0] + 1 == len(pages):
+                self._device_pages[device] = range(pages[0], pages[-1] + 1)
+        for page in range(PAGE_COUNT):
+            self._apply_watch(page)
+            for callback in self._watchers[page]:
+                callback(page, None)
+
+    def _set_page(self, page, device, offset):
+        start = (page << 8) - offset
+        dispatch = None
+        read = self._view(device.read_buffer, start)
+        if read is None:
+            read = dispatch = _DevicePage(device, -start)
+        write = self._view(device.write_buffer, start)
+        if write is None:
+            write = dispatch or _DevicePage(device, -start)
+        elif device.dirty_pages is not None:
+            write = _DirtyPage(write, device.dirty_pages, start)
+        self.read_pages[page] = read
+        self._write_targets[page] = write
+
+    def _apply_mirrors(self):
+        """Points the pages of every mirror at the pages they show. Returns the pages involved"""
+        self._aliases = [(page,) for page in range(PAGE_COUNT)]
+        self._exact = [True] * PAGE_COUNT
+        self._mirrored_devices = set()
+        pages, reads, writes = list(self._pages), list(self.read_pages), list(self._write_targets)
+        groups = dict()     # Target page to the pages showing it
+        exact = dict()
+        for addresses, mask in self.mirrors.items():
+            low = mask & 0xFF
+            for page in range(addresses.start >> 8, addresses.stop >> 8):
+                target = ((page << 8) & mask) >> 8
+                self._pages[page] = pages[target]
+                if low == 0xFF:
+                    self.read_pages[page], self._write_targets[page] = reads[target], writes[target]
+                else:
+                    self.read_pages[page] = _MirrorPage(reads[target], low)
+                    self._write_targets[page] = _MirrorPage(writes[target], low)
+                groups.setdefault(target, {target}).add(page)
+                exact[target] = exact.get(target, True) and low == 0xFF
+        for target, group in groups.items():
+            group = tuple(sorted(group))
+            for page in group:
+                self._aliases[page] = group
+                self._exact[page] = exact[target]
+                self._mirrored_devices.add(self._pages[page][0])
+        return {page for group in groups.values() for page in group}
+
+    @staticmethod
+    def _view(buffer, start):
+        """A page sized view into a device buffer, if the page lies entirely within it"""
+        if buffer is None or start < 0 or start + PAGE_SIZE > len(buffer):
+            return None
+        return memoryview(buffer)[start:start + PAGE_SIZE]
+
+    def _map(self, addresses, device, offset):
+        start = max(addresses.start, 0)
+        stop = min(addresses.stop, PAGE_SIZE * PAGE_COUNT)
+        for page in range(start >> 8, ((stop - 1) >> 8) + 1):
+            base = page << 8
+            if start <= base and base + PAGE_SIZE <= stop:
+                self._pages[page] = (device, offset)
+                continue
+            sub_page, sub_offset = self._pages[page]
+            if not isinstance(sub_page, _SubPage):
+                sub_page = _SubPage(base, sub_page, sub_offset)
+                self._pages[page] = (sub_page, base)
+            for address in range(max(start, base), min(stop, base + PAGE_SIZE)):
+                sub_page.entries[address - base] = (device, offset - base)
+            self._split_devices.add(device)
+
+    def watch(self, page, callback):
+        """Calls callback(page, index) after every write into page, and callback(page, None) whenever the
+        page is remapped. Writes to a watched page no longer go straight into RAM"""
+        if callback not in self._watchers[page]:
+            self._watchers[page] += (callback,)
+            self._apply_watch(page)
+
+    def unwatch(self, page, callback):
+        self._watchers[page] = tuple(watcher for watcher in self._watchers[page] if watcher != callback)
+        self._apply_watch(page)
+
+    def _apply_watch(self, page):
+        group = self._aliases[page]
+        calls = tuple((callback, other, self._exact[other]) for other in group for callback in self._watchers[other])
+        for member in group:
+            if calls:
+                self.write_pages[member] = _WatchedPage(self, calls, self._write_targets[member])
+            else:
+                self.write_pages[member] = self._write_targets[member]
+
+    @property
+    def cycles(self):
+        """Current cycle stamp, taken from the cpu"""
+        return self.cpu.total_cycles if self.cpu else 0
+
+    def schedule(self, delay, callback):
+        """Calls callback(cycle) once delay cycles have elapsed. Returns a handle for cancel()"""
+        return self.schedule_at(self.cycles + delay, callback)
+
+    def schedule_at(self, cycle, callback):
+        """Calls callback(cycle) at the first instruction boundary at or after the cycle stamp"""
+        event = [cycle, next(self._sequence), callback]
+        heapq.heappush(self._events, event)
+        if cycle < self.next_event:
+            self.next_event = cycle
+            if self.cpu and cycle < self.cpu.deadline:
+                self.cpu.deadline = cycle
+        return event
+
+    def cancel(self, event):
+        event[2] = None
+
+    def run_events(self):
+        """Calls every callback that is due, in cycle order"""
+        events = self._events
+        while events and events[0][0] <= self.cycles:
+            cycle, _, callback = heapq.heappop(events)
+            if callback is not None:
+                callback(cycle)
+        self.next_event = events[0][0] if events else NEVER
+
+    def devices(self):
+        """Every device on the bus once, in registration order"""
+        out = list()
+        for device, _ in self.mapping.values():
+            if device not in out:
+                out.append(device)
+        return out
+
+    def snapshot(self, previous=None):
+        """State of every device, sharing unchanged pages with the previous snapshot of this bus"""
+        devices = self.devices()
+        previous = previous or (None,) * len(devices)
+        return tuple(device.snapshot(old) for device, old in zip(devices, previous))
+
+    def restore(self, states):
+        """Puts back the device states of a snapshot taken from this bus or one built the same way"""
+        for device, state in zip(self.devices(), states):
+            device.restore(state)
+        # Memory changed behind the write pages, so tell watchers as if every watched page was remapped
+        for page in range(PAGE_COUNT):
+            for callback in self._watchers[page]:
+                callback(page, None)
 
     def irq(self):
         if self.cpu:
@@ -65,6 +438,30 @@ class BusDevice(abc.ABC):
     def absolute_address(self):
         pass
 
+    @property
+    def read_buffer(self):
+        """Buffer the bus may read directly instead of calling __getitem__, None for memory-mapped I/O"""
+        return None
+
+    @property
+    def write_buffer(self):
+        """Buffer the bus may write directly instead of calling __setitem__, None for memory-mapped I/O"""
+        return None
+
+    @property
+    def dirty_pages(self):
+        """Bitmap with a byte per 256 bytes of write_buffer, set to 0xFF when the bus writes into it directly.
+        None when the device does not track writes"""
+        return None
+
+    def snapshot(self, previous=None):
+        """Picklable state of the device. previous is the state from the last snapshot, whose unchanged
+        parts may be shared rather than copied. Devices without state return None"""
+        return None
+
+    def restore(self, state):
+        pass
+
     def irq(self):
         self.bus.irq()
 
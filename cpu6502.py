@@ -2,22 +2,32 @@
 # -*- coding: utf-8 -*-
 """A python version of the MOS 6502 Processor"""
 
-import abc
 import itertools
-from collections import OrderedDict
+import textwrap
+from collections import OrderedDict, namedtuple
+
+
+FLAG_N = 1 << 7    # Negative
+FLAG_V = 1 << 6    # Overflow
+FLAG_U = 1 << 5    # Unused
+FLAG_B = 1 << 4    # Break
+FLAG_D = 1 << 3    # Decimal
+FLAG_I = 1 << 2    # Interrupt disable
+FLAG_Z = 1 << 1    # Zero
+FLAG_C = 1 << 0    # Carry
 
 
 class _Status:
     """Performs the role of a status enum allowing us to select multiple bits"""
     def __init__(self):
-        self.values = dict(N=1 << 7,
-                           V=1 << 6,
-                           U=1 << 5,
-                           B=1 << 4,
-                           D=1 << 3,
-                           I=1 << 2,
-                           Z=1 << 1,
-                           C=1 << 0)
+        self.values = dict(N=FLAG_N,
+                           V=FLAG_V,
+                           U=FLAG_U,
+                           B=FLAG_B,
+                           D=FLAG_D,
+                           I=FLAG_I,
+                           Z=FLAG_Z,
+                           C=FLAG_C)
 
     def __getitem__(self, item):
         if isinstance(item, str):
@@ -39,1275 +49,930 @@ class _Status:
 Status = _Status()
 
 
-class Ops6502:
-    """This class contains all the opcodes - no need for separate class other than for code organisation"""
-    def __init__(self, bus):
-        """Dummy values"""
-        self.A = 0
-        self.X = 0
-        self.Y = 0
-        self.S = 0
-        self.PC = 0
-        self.P = 0
-        self.bus = bus
-        self.cycles = 0
-
-    @abc.abstractmethod
-    def _read_pc(self): pass
-
-    @abc.abstractmethod
-    def _read_bytes_pc(self, length): pass
-
-    @abc.abstractmethod
-    def _pop_stack(self): pass
-
-    @abc.abstractmethod
-    def _push_stack(self, val): pass
-
-    def _set_if_true(self, condition, flag):
-        """Helper function to set status of individual bits"""
-        if condition:
-            self.P |= Status[flag]
-        else:
-            self.P &= ~Status[flag]
-
-    def op_adc(self, address_func):
-        address, operand, extra_cycle = address_func()
-        if extra_cycle:
-            self.cycles += 1
-
-        if self.P & Status['D']:
-            if self.P & Status['C']:
-                carry = 1
-            else:
-                carry = 0
-            intermediate = (self.A & 0x0F) + (operand & 0x0F) + carry
-
-            if intermediate >= 0x0A:
-                intermediate = ((intermediate + 0x06) & 0x0F) + 0x10
-
-            output = (self.A & 0xF0) + (operand & 0xF0) + intermediate
-            self._set_if_true(output > 0xFF, 'V')
-            if output >= 0xA0:
-                output += 0x60
-            self._set_if_true(output >= 0x100, 'C')
-            output &= 0xFF
-            self._set_if_true(output & 0x80, 'N')
-            self._set_if_true(output == 0, 'Z')
-        else:
-            if self.P & Status['C']:
-                carry = 1
-            else:
-                carry = 0
-            output = self.A + operand + carry
-
-            # Set Flags
-            self._set_if_true(output > 0xFF, 'C')
-            output &= 0xFF
-            self._set_if_true(output == 0, 'Z')
-            self._set_if_true(output & 0x80, 'N')
-            v_flag = 0
-            if self.A & 0x80:
-                v_flag += 1
-            if operand & 0x80:
-                v_flag += 1
-            if output & 0x80:
-                v_flag += 2
-            self._set_if_true(v_flag == 2, 'V')
-        self.A = output
-
-    def op_and(self, address_func):
-        _, operand, extra_cycle = address_func()
-        if extra_cycle:
-            self.cycles += 1
-
-        output = self.A & operand
-        self._set_if_true(output == 0, 'Z')
-        self._set_if_true(output & 0x80, 'N')
-        self.A = output
-
-    def op_asl(self, address_func):
-        address, operand, _ = address_func()
-        output = operand << 1
-        self._set_if_true(output > 0xFF, 'C')
-        output &= 0xFF
-        self._set_if_true(output & 0x80, 'N')
-        self._set_if_true(output == 0, 'Z')
-
-        if address is 'ACCUMULATOR':
-            self.A = output
-        else:
-            self.bus[address] = output
-
-    def op_bbr0(self, address_func):
-        address, operand, _ = address_func()  # Zero page Operand and Rel address
-        n = 0
-        if not operand & (1 << n):
-            self.PC = address
-
-    def op_bbr1(self, address_func):
-        address, operand, _ = address_func()  # Zero page Operand and Rel address
-        n = 1
-        if not operand & (1 << n):
-            self.PC = address
-
-    def op_bbr2(self, address_func):
-        address, operand, _ = address_func()  # Zero page Operand and Rel address
-        n = 2
-        if not operand & (1 << n):
-            self.PC = address
-
-    def op_bbr3(self, address_func):
-        address, operand, _ = address_func()  # Zero page Operand and Rel address
-        n = 3
-        if not operand & (1 << n):
-            self.PC = address
-
-    def op_bbr4(self, address_func):
-        address, operand, _ = address_func()  # Zero page Operand and Rel address
-        n = 4
-        if not operand & (1 << n):
-            self.PC = address
-
-    def op_bbr5(self, address_func):
-        address, operand, _ = address_func()  # Zero page Operand and Rel address
-        n = 5
-        if not operand & (1 << n):
-            self.PC = address
-
-    def op_bbr6(self, address_func):
-        address, operand, _ = address_func()  # Zero page Operand and Rel address
-        n = 6
-        if not operand & (1 << n):
-            self.PC = address
-
-    def op_bbr7(self, address_func):
-        address, operand, _ = address_func()  # Zero page Operand and Rel address
-        n = 7
-        if not operand & (1 << n):
-            self.PC = address
-
-    def op_bbs0(self, address_func):
-        address, operand, _ = address_func()  # Zero page Operand and Rel address
-        n = 0
-        if operand & (1 << n):
-            self.PC = address
-
-    def op_bbs1(self, address_func):
-        address, operand, _ = address_func()  # Zero page Operand and Rel address
-        n = 1
-        if operand & (1 << n):
-            self.PC = address
-
-    def op_bbs2(self, address_func):
-        address, operand, _ = address_func()  # Zero page Operand and Rel address
-        n = 2
-        if operand & (1 << n):
-            self.PC = address
-
-    def op_bbs3(self, address_func):
-        address, operand, _ = address_func()  # Zero page Operand and Rel address
-        n = 3
-        if operand & (1 << n):
-            self.PC = address
-
-    def op_bbs4(self, address_func):
-        address, operand, _ = address_func()  # Zero page Operand and Rel address
-        n = 4
-        if operand & (1 << n):
-            self.PC = address
-
-    def op_bbs5(self, address_func):
-        address, operand, _ = address_func()  # Zero page Operand and Rel address
-        n = 5
-        if operand & (1 << n):
-            self.PC = address
-
-    def op_bbs6(self, address_func):
-        address, operand, _ = address_func()  # Zero page Operand and Rel address
-        n = 6
-        if operand & (1 << n):
-            self.PC = address
-
-    def op_bbs7(self, address_func):
-        address, operand, _ = address_func()  # Zero page Operand and Rel address
-        n = 7
-        if operand & (1 << n):
-            self.PC = address
-
-    def op_bcc(self, address_func):
-        address, _, _ = address_func()
-        if not self.P & Status['C']:
-            if (address & 0xFF00) != (self.PC & 0xFF00):
-                self.cycles += 1
-            self.PC = address
-        else:
-            self.cycles = 0
-
-    def op_bcs(self, address_func):
-        address, _, _ = address_func()
-        if self.P & Status['C']:
-            if (address & 0xFF00) != (self.PC & 0xFF00):
-                self.cycles += 1
-            self.PC = address
-        else:
-            self.cycles = 0
-
-    def op_beq(self, address_func):
-        address, _, _ = address_func()
-        if self.P & Status['Z']:
-            if (address & 0xFF00) != (self.PC & 0xFF00):
-                self.cycles += 1
-            self.PC = address
-        else:
-            self.cycles = 0
-
-    def op_bit(self, address_func):
-        _, operand, _ = address_func()
-        self._set_if_true((operand & self.A) == 0, 'Z')
-        self._set_if_true(operand & 0x80, 'N')
-        self._set_if_true(operand & (1 << 6), 'V')
-
-    def op_bit_imm(self, address_func):
-        _, operand, _ = address_func()
-        self._set_if_true((operand & self.A) == 0, 'Z')
-
-    def op_bmi(self, address_func):
-        address, _, _ = address_func()
-        if self.P & Status['N']:
-            if (address & 0xFF00) != (self.PC & 0xFF00):
-                self.cycles += 1
-            self.PC = address
-        else:
-            self.cycles = 0
-
-    def op_bne(self, address_func):
-        address, _, _ = address_func()
-        if not self.P & Status['Z']:
-            if (address & 0xFF00) != (self.PC & 0xFF00):
-                self.cycles += 1
-            self.PC = address
-        else:
-            self.cycles = 0
-
-    def op_bpl(self, address_func):
-        address, _, _ = address_func()
-        if not self.P & Status['N']:
-            if (address & 0xFF00) != (self.PC & 0xFF00):
-                self.cycles += 1
-            self.PC = address
-        else:
-            self.cycles = 0
-
-    def op_bra(self, address_func):
-        address, _, _ = address_func()
-        if (address & 0xFF00) != (self.PC & 0xFF00):
-            self.cycles += 1
-        self.PC = address
-
-    def op_brk(self, _):
-        self.P |= Status['B']
-        self.PC += 1
-        self._push_stack((self.PC & 0xFF00) >> 8)  # PC high byte
-        self._push_stack(self.PC & 0xFF)  # PC Low byte
-        self._push_stack(self.P)  # Status register
-        self.P |= Status['I']
-        self.P &= ~Status['D']
-        irq_location = 0xFFFE
-        self.PC = self.bus[irq_location] | self.bus[irq_location + 1] << 8
-
-    def op_bvc(self, address_func):
-        address, _, _ = address_func()
-        if not self.P & Status['V']:
-            if (address & 0xFF00) != (self.PC & 0xFF00):
-                self.cycles += 1
-            self.PC = address
+# Instruction handlers are generated from the source snippets below, fusing the addressing mode into the
+# operation so that each opcode executes as a single function call. Snippets run with these locals:
+#   cpu      the Cpu6502 instance, with PC already past the opcode
+#   rp, wp   the bus read/write pages, indexed [address >> 8][address & 0xFF]
+#   address  effective address set by the addressing mode
+#   operand  value read from address (or the immediate/accumulator value)
+#   cycles   cycle count of the instruction, returned by the handler
+# Mode snippets refer to their operand bytes as {b1} and {b2} and to the following instruction as {next}.
+
+# name: (operand bytes, source, disassembly format)
+_MODES = {
+    'absolute': (2, '''
+        address = {b1} | {b2} << 8
+        ''', '${1:02X}{0:02X} [a]'),
+    'absolute_indirect_x': (2, '''
+        pointer = ({b1} | {b2} << 8) + cpu.X
+        if cpu._zero_page_bug and (pointer & 0xFF) == 0xFF:
+            high = pointer & 0xFF00
         else:
-            self.cycles = 0
-
-    def op_bvs(self, address_func):
-        address, _, _ = address_func()
-        if self.P & Status['V']:
-            if (address & 0xFF00) != (self.PC & 0xFF00):
-                self.cycles += 1
-            self.PC = address
+            high = pointer + 1
+        address = rp[high >> 8][high & 0xFF] << 8 | rp[pointer >> 8][pointer & 0xFF]
+        ''', '$({1:02X}{0:02X}, X) [(a,x)]'),
+    'absolute_x': (2, '''
+        base = {b1} | {b2} << 8
+        address = base + cpu.X
+        ''', '${1:02X}{0:02X}, X [a, x]'),
+    'absolute_y': (2, '''
+        base = {b1} | {b2} << 8
+        address = base + cpu.Y
+        ''', '${1:02X}{0:02X}, Y [a, y]'),
+    'accumulator': (0, '''
+        operand = cpu.A
+        ''', '[Acc]'),
+    'immediate': (1, '''
+        operand = {b1}
+        ''', '#{0:02X} [Imm]'),
+    'implied': (0, '', '[Imp]'),
+    'indirect': (2, '''
+        pointer = {b1} | {b2} << 8
+        if cpu._zero_page_bug and (pointer & 0xFF) == 0xFF:
+            high = pointer & 0xFF00
         else:
-            self.cycles = 0
-
-    def op_clc(self, _):
-        self.P &= ~Status['C']
-
-    def op_cld(self, _):
-        self.P &= ~Status['D']
-
-    def op_cli(self, _):
-        self.P &= ~Status['I']
-
-    def op_clv(self, _):
-        self.P &= ~Status['V']
-
-    def op_cmp(self, address_func):
-        _, operand, extra_cycle = address_func()
-        if extra_cycle:
-            self.cycles += 1
-        self._set_if_true(operand == self.A, 'Z')
-        self._set_if_true(self.A >= operand, 'C')
-        self._set_if_true((self.A - operand) & 0x80, 'N')
-
-    def op_cpx(self, address_func):
-        _, operand, extra_cycle = address_func()
-        self._set_if_true(operand == self.X, 'Z')
-        self._set_if_true(self.X >= operand, 'C')
-        self._set_if_true((self.X - operand) & 0x80, 'N')
-
-    def op_cpy(self, address_func):
-        _, operand, extra_cycle = address_func()
-        self._set_if_true(operand == self.Y, 'Z')
-        self._set_if_true(self.Y >= operand, 'C')
-        self._set_if_true((self.Y - operand) & 0x80, 'N')
-
-    def op_dec(self, address_func):
-        address, operand, _ = address_func()
-        operand = (operand - 1) & 0xFF
-        self._set_if_true(operand == 0, 'Z')
-        self._set_if_true(operand & 0x80, 'N')
-        if address is 'ACCUMULATOR':
-            self.A = operand
-        else:
-            self.bus[address] = operand
-
-    def op_dex(self, _):
-        operand = (self.X - 1) & 0xFF
-        self._set_if_true(operand == 0, 'Z')
-        self._set_if_true(operand & 0x80, 'N')
-        self.X = operand
-
-    def op_dey(self, _):
-        operand = (self.Y - 1) & 0xFF
-        self._set_if_true(operand == 0, 'Z')
-        self._set_if_true(operand & 0x80, 'N')
-        self.Y = operand
-
-    def op_eor(self, address_func):
-        _, operand, extra_cycle = address_func()
-        if extra_cycle:
-            self.cycles += 1
-        out = self.A ^ operand
-        self._set_if_true(out == 0, 'Z')
-        self._set_if_true(out & 0x80, 'N')
-        self.A = out
-
-    def op_inc(self, address_func):
-        address, operand, _ = address_func()
-        operand = (operand + 1) & 0xFF
-        self._set_if_true(operand == 0, 'Z')
-        self._set_if_true(operand & 0x80, 'N')
-        if address is 'ACCUMULATOR':
-            self.A = operand
-        else:
-            self.bus[address] = operand
-
-    def op_inx(self, _):
-        operand = (self.X + 1) & 0xFF
-        self._set_if_true(operand == 0, 'Z')
-        self._set_if_true(operand & 0x80, 'N')
-        self.X = operand
-
-    def op_iny(self, _):
-        operand = (self.Y + 1) & 0xFF
-        self._set_if_true(operand == 0, 'Z')
-        self._set_if_true(operand & 0x80, 'N')
-        self.Y = operand
-
-    def op_jmp(self, address_func):
-        address, _, _ = address_func()
-        self.PC = address
-
-    def op_jsr(self, address_func):
-        address, _, _ = address_func()
-        self.PC -= 1
-        self._push_stack((self.PC & 0xFF00) >> 8)  # PC high byte
-        self._push_stack(self.PC & 0xFF)  # PC Low byte
-        self.PC = address
-
-    def op_lda(self, address_func):
-        _, operand, extra_cycle = address_func()
-        if extra_cycle:
-            self.cycles += 1
-        self._set_if_true(operand == 0, 'Z')
-        self._set_if_true(operand & 0x80, 'N')
-        self.A = operand
-
-    def op_ldx(self, address_func):
-        _, operand, extra_cycle = address_func()
-        if extra_cycle:
-            self.cycles += 1
-        self._set_if_true(operand == 0, 'Z')
-        self._set_if_true(operand & 0x80, 'N')
-        self.X = operand
-
-    def op_ldy(self, address_func):
-        _, operand, extra_cycle = address_func()
-        if extra_cycle:
-            self.cycles += 1
-        self._set_if_true(operand == 0, 'Z')
-        self._set_if_true(operand & 0x80, 'N')
-        self.Y = operand
-
-    def op_lsr(self, address_func):
-        address, operand, _ = address_func()
-        self._set_if_true(operand & 0x01, 'C')
-        operand = operand >> 1
-        self._set_if_true(operand == 0, 'Z')
-        self._set_if_true(operand & 0x80, 'N')
-
-        if address is 'ACCUMULATOR':
-            self.A = operand
-        else:
-            self.bus[address] = operand
-
-    def op_nop(self, _):
-        pass
-
-    def op_ora(self, address_func):
-        _, operand, extra_cycle = address_func()
-        if extra_cycle:
-            self.cycles += 1
-        operand = operand | self.A
-        self._set_if_true(operand == 0, 'Z')
-        self._set_if_true(operand & 0x80, 'N')
-        self.A = operand
-
-    def op_pha(self, _):
-        self._push_stack(self.A)
-
-    def op_php(self, _):
-        self.P |= Status['B']  # Undocumented behaviour?
-        self._push_stack(self.P)
-
-    def op_phx(self, _):
-        self._push_stack(self.X)
-
-    def op_phy(self, _):
-        self._push_stack(self.Y)
-
-    def op_pla(self, _):
-        data = self._pop_stack()
-        self._set_if_true(data == 0, 'Z')
-        self._set_if_true(data & 0x80, 'N')
-        self.A = data
-
-    def op_plp(self, _):
-        self.P = self._pop_stack() | Status['U']  # Unused bit must be set at all times
-
-    def op_plx(self, _):
-        data = self._pop_stack()
-        self._set_if_true(data == 0, 'Z')
-        self._set_if_true(data & 0x80, 'N')
-        self.X = data
-
-    def op_ply(self, _):
-        data = self._pop_stack()
-        self._set_if_true(data == 0, 'Z')
-        self._set_if_true(data & 0x80, 'N')
-        self.Y = data
-
-    def op_rmb0(self, address_func):
-        address, operand, _ = address_func()
-        n = 0
-        operand = operand & ~(1 << n)
-        self.bus[address] = operand
-
-    def op_rmb1(self, address_func):
-        address, operand, _ = address_func()
-        n = 1
-        operand = operand & ~(1 << n)
-        self.bus[address] = operand
-
-    def op_rmb2(self, address_func):
-        address, operand, _ = address_func()
-        n = 2
-        operand = operand & ~(1 << n)
-        self.bus[address] = operand
-
-    def op_rmb3(self, address_func):
-        address, operand, _ = address_func()
-        n = 3
-        operand = operand & ~(1 << n)
-        self.bus[address] = operand
-
-    def op_rmb4(self, address_func):
-        address, operand, _ = address_func()
-        n = 4
-        operand = operand & ~(1 << n)
-        self.bus[address] = operand
-
-    def op_rmb5(self, address_func):
-        address, operand, _ = address_func()
-        n = 5
-        operand = operand & ~(1 << n)
-        self.bus[address] = operand
-
-    def op_rmb6(self, address_func):
-        address, operand, _ = address_func()
-        n = 6
-        operand = operand & ~(1 << n)
-        self.bus[address] = operand
-
-    def op_rmb7(self, address_func):
-        address, operand, _ = address_func()
-        n = 7
-        operand = operand & ~(1 << n)
-        self.bus[address] = operand
-
-    def op_rol(self, address_func):
-        address, operand, _ = address_func()
-        to_carry = operand & 0x80
-        if self.P & Status['C']:
-            carry = 1
-        else:
-            carry = 0
-        operand = ((operand << 1) & 0xFF) + carry
-        self._set_if_true(to_carry, 'C')
-        self._set_if_true(operand == 0, 'Z')
-        self._set_if_true(operand & 0x80, 'N')
-
-        if address is 'ACCUMULATOR':
-            self.A = operand
-        else:
-            self.bus[address] = operand
-
-    def op_ror(self, address_func):
-        address, operand, _ = address_func()
-        to_carry = operand & 0x01
-        if self.P & Status['C']:
-            carry = 0x80
-        else:
-            carry = 0
-        operand = ((operand >> 1) & 0xFF) + carry
-        self._set_if_true(to_carry, 'C')
-        self._set_if_true(operand == 0, 'Z')
-        self._set_if_true(operand & 0x80, 'N')
-
-        if address is 'ACCUMULATOR':
-            self.A = operand
-        else:
-            self.bus[address] = operand
-
-    def op_rti(self, _):
-        self.P = self._pop_stack() | Status['U']  # Unused bit must be set
-        low = self._pop_stack()
-        high = self._pop_stack()
-        self.PC = (high << 8) + low
-
-    def op_rts(self, _):
-        low = self._pop_stack()
-        high = self._pop_stack()
-        self.PC = (high << 8) + low + 1
-
-    def op_sbc(self, address_func):
-        _, operand, extra_cycle = address_func()
-        if extra_cycle:
-            self.cycles += 1
-
-        if self.P & Status['D']:
-
+            high = pointer + 1
+        address = rp[high >> 8][high & 0xFF] << 8 | rp[pointer >> 8][pointer & 0xFF]
+        ''', '$({1:02X}{0:02X}) [(a)]'),
+    'relative': (1, '''
+        address = {next} + ({b1} ^ 0x80) - 0x80
+        ''', '-> {{{0:04X}}} [Rel]'),
+    'stack': (0, '', '[Sta]'),
+    'zero_page': (1, '''
+        address = {b1}
+        ''', '${0:02X} [zp]'),
+    'zero_page_relative': (2, '''
+        operand = rp[0][{b1}]
+        address = {next} + ({b2} ^ 0x80) - 0x80
+        ''', '${0:02X} -> {{{1:04X}}} [zp Rel]'),
+    'zero_page_indirect': (1, '''
+        pointer = {b1}
+        address = rp[0][(pointer + 1) & 0xFF] << 8 | rp[0][pointer]
+        ''', '$({0:02X}) [(zp)]'),
+    'zero_page_indirect_x': (1, '''
+        pointer = ({b1} + cpu.X) & 0xFF
+        address = rp[0][(pointer + 1) & 0xFF] << 8 | rp[0][pointer]
+        ''', '$({0:02X}, X) [(zp, x)]'),
+    'zero_page_indirect_y': (1, '''
+        pointer = {b1}
+        address = (rp[0][(pointer + 1) & 0xFF] << 8 | rp[0][pointer]) + cpu.Y
+        ''', '(${0:02X}), Y [(zp), y]'),
+    'zero_page_x': (1, '''
+        address = ({b1} + cpu.X) & 0xFF
+        ''', '${0:02X}, X [zp, x]'),
+    'zero_page_y': (1, '''
+        address = ({b1} + cpu.Y) & 0xFF
+        ''', '${0:02X}, Y [zp, y]'),
+}
+
+_ZERO_PAGE_MODES = {'zero_page', 'zero_page_x', 'zero_page_y'}   # Effective address always in page zero
+_OPERAND_MODES = {'accumulator', 'immediate', 'zero_page_relative'}  # Modes that supply the operand themselves
+_PAGE_PENALTY_MODES = {'absolute_x', 'absolute_y'}  # Modes that take a cycle longer crossing a page
+
+# Operation snippets are formatted with the flag masks ({C}, {Z}, ...) and {store}, the target of a
+# read-modify-write. Status bits live in cpu._p, except that N and Z are handled by the macros below:
+# {set_nz}, {set_n} and {set_z} update them from the local `result` and {n_set}, {z_set}, ... test them.
+# In lazy mode N and Z are not computed at all; the values they derive from are kept in cpu._n and cpu._z
+# and only folded into the status register when P is read.
+_EAGER_FLAGS = dict(
+    set_nz='cpu._p = cpu._p & 0x7D | result & 0x80 | (result == 0) << 1',
+    set_n='cpu._p = cpu._p & 0x7F | result & 0x80',
+    set_z='cpu._p = cpu._p & 0xFD | (result == 0) << 1',
+    n_set='cpu._p & 0x80',
+    n_clear='not cpu._p & 0x80',
+    z_set='cpu._p & 0x02',
+    z_clear='not cpu._p & 0x02',
+)
+
+_LAZY_FLAGS = dict(
+    set_nz='cpu._n = cpu._z = result',
+    set_n='cpu._n = result',
+    set_z='cpu._z = result',
+    n_set='cpu._n & 0x80',
+    n_clear='not cpu._n & 0x80',
+    z_set='not cpu._z',
+    z_clear='cpu._z',
+)
+
+_ADD = '''
+    a = cpu.A
+    carry = cpu._p & {C}
+    if cpu._p & {D}:
+        intermediate = (a & 0x0F) + (operand & 0x0F) + carry
+        if intermediate >= 0x0A:
+            intermediate = ((intermediate + 0x06) & 0x0F) + 0x10
+        output = (a & 0xF0) + (operand & 0xF0) + intermediate
+        overflow = output > 0xFF
+        if output >= 0xA0:
+            output += 0x60
+    else:
+        output = a + operand + carry
+        overflow = (a ^ output) & (operand ^ output) & 0x80
+    p = cpu._p & ~({C} | {V})
+    if output > 0xFF:
+        p |= {C}
+    if overflow:
+        p |= {V}
+    cpu._p = p
+    result = output & 0xFF
+    {set_nz}
+    cpu.A = result
+    '''
+
+# A taken branch costs one extra cycle, two if it lands in another page
+_BRANCH = '''
+    if {condition}:
+        cycles += 2 if (address ^ cpu.PC) & 0xFF00 else 1
+        cpu.PC = address
+    '''
+
+_COMPARE = '''
+    register = {register}
+    result = (register - operand) & 0xFF
+    if register >= operand:
+        cpu._p |= {{C}}
+    else:
+        cpu._p &= ~{{C}}
+    {{set_nz}}
+    '''
+
+_LOAD = '''
+    result = {value}
+    {{set_nz}}
+    {register} = result
+    '''
+
+_PUSH = '''
+    wp[1][cpu.S] = {value}
+    cpu.S = (cpu.S - 1) & 0xFF
+    '''
+
+_PULL = '''
+    cpu.S = (cpu.S + 1) & 0xFF
+    result = rp[1][cpu.S]
+    {{set_nz}}
+    {register} = result
+    '''
+
+# name: (reads operand, source)
+_OPERATIONS = {
+    'adc': (True, _ADD),
+    'and': (True, _LOAD.format(register='cpu.A', value='cpu.A & operand')),
+    'asl': (True, '''
+        cpu._p = cpu._p & ~{C} | operand >> 7
+        result = (operand << 1) & 0xFF
+        {set_nz}
+        {store} = result
+        '''),
+    'bit': (True, '''
+        cpu._p = cpu._p & ~{V} | operand & {V}
+        result = operand
+        {set_n}
+        result = operand & cpu.A
+        {set_z}
+        '''),
+    'bit_imm': (True, '''
+        result = operand & cpu.A
+        {set_z}
+        '''),
+    'bra': (False, '''
+        if (address ^ cpu.PC) & 0xFF00:
+            cycles += 1
+        cpu.PC = address
+        '''),
+    'brk': (False, '''
+        cpu._p |= {B}
+        cpu.PC = ret = cpu.PC + 1
+        wp[1][cpu.S] = (ret & 0xFF00) >> 8
+        wp[1][(cpu.S - 1) & 0xFF] = ret & 0xFF
+        wp[1][(cpu.S - 2) & 0xFF] = cpu.P
+        cpu.S = (cpu.S - 3) & 0xFF
+        cpu._p = (cpu._p | {I}) & ~{D}
+        cpu.PC = rp[0xFF][0xFE] | rp[0xFF][0xFF] << 8
+        '''),
+    'clc': (False, 'cpu._p &= ~{C}'),
+    'cld': (False, 'cpu._p &= ~{D}'),
+    'cli': (False, 'cpu._p &= ~{I}'),
+    'clv': (False, 'cpu._p &= ~{V}'),
+    'cmp': (True, _COMPARE.format(register='cpu.A')),
+    'cpx': (True, _COMPARE.format(register='cpu.X')),
+    'cpy': (True, _COMPARE.format(register='cpu.Y')),
+    'dec': (True, '''
+        result = (operand - 1) & 0xFF
+        {set_nz}
+        {store} = result
+        '''),
+    'dex': (False, _LOAD.format(register='cpu.X', value='(cpu.X - 1) & 0xFF')),
+    'dey': (False, _LOAD.format(register='cpu.Y', value='(cpu.Y - 1) & 0xFF')),
+    'eor': (True, _LOAD.format(register='cpu.A', value='cpu.A ^ operand')),
+    'inc': (True, '''
+        result = (operand + 1) & 0xFF
+        {set_nz}
+        {store} = result
+        '''),
+    'inx': (False, _LOAD.format(register='cpu.X', value='(cpu.X + 1) & 0xFF')),
+    'iny': (False, _LOAD.format(register='cpu.Y', value='(cpu.Y + 1) & 0xFF')),
+    'jmp': (False, 'cpu.PC = address'),
+    'jsr': (False, '''
+        ret = cpu.PC - 1
+        wp[1][cpu.S] = (ret & 0xFF00) >> 8
+        wp[1][(cpu.S - 1) & 0xFF] = ret & 0xFF
+        cpu.S = (cpu.S - 2) & 0xFF
+        cpu.PC = address
+        '''),
+    'lda': (True, _LOAD.format(register='cpu.A', value='operand')),
+    'ldx': (True, _LOAD.format(register='cpu.X', value='operand')),
+    'ldy': (True, _LOAD.format(register='cpu.Y', value='operand')),
+    'lsr': (True, '''
+        cpu._p = cpu._p & ~{C} | operand & 0x01
+        result = operand >> 1
+        {set_nz}
+        {store} = result
+        '''),
+    'nop': (False, 'pass'),
+    'ora': (True, _LOAD.format(register='cpu.A', value='cpu.A | operand')),
+    'pha': (False, _PUSH.format(value='cpu.A')),
+    'php': (False, 'cpu._p |= {B}  # Undocumented behaviour?\n' + textwrap.dedent(_PUSH.format(value='cpu.P'))),
+    'phx': (False, _PUSH.format(value='cpu.X')),
+    'phy': (False, _PUSH.format(value='cpu.Y')),
+    'pla': (False, _PULL.format(register='cpu.A')),
+    'plp': (False, '''
+        cpu.S = (cpu.S + 1) & 0xFF
+        cpu.P = rp[1][cpu.S] | {U}  # Unused bit must be set at all times
+        '''),
+    'plx': (False, _PULL.format(register='cpu.X')),
+    'ply': (False, _PULL.format(register='cpu.Y')),
+    'rol': (True, '''
+        result = ((operand << 1) & 0xFF) | cpu._p & {C}
+        cpu._p = cpu._p & ~{C} | operand >> 7
+        {set_nz}
+        {store} = result
+        '''),
+    'ror': (True, '''
+        result = (operand >> 1) | (cpu._p & {C}) << 7
+        cpu._p = cpu._p & ~{C} | operand & 0x01
+        {set_nz}
+        {store} = result
+        '''),
+    'rti': (False, '''
+        s = cpu.S
+        cpu.P = rp[1][(s + 1) & 0xFF] | {U}  # Unused bit must be set
+        cpu.PC = rp[1][(s + 2) & 0xFF] | rp[1][(s + 3) & 0xFF] << 8
+        cpu.S = (s + 3) & 0xFF
+        '''),
+    'rts': (False, '''
+        s = cpu.S
+        cpu.PC = (rp[1][(s + 1) & 0xFF] | rp[1][(s + 2) & 0xFF] << 8) + 1
+        cpu.S = (s + 2) & 0xFF
+        '''),
+    'sbc': (True, textwrap.dedent('''
+        if cpu._p & {D}:
             # Calculate 99 - operand then add
             operand = (0x90 - (operand & 0xF0)) + (0x09 - (operand & 0x0F))
-            if self.P & Status['C']:
-                carry = 1
-            else:
-                carry = 0
-            intermediate = (self.A & 0x0F) + (operand & 0x0F) + carry
-
-            if intermediate >= 0x0A:
-                intermediate = ((intermediate + 0x06) & 0x0F) + 0x10
-
-            output = (self.A & 0xF0) + (operand & 0xF0) + intermediate
-            self._set_if_true(output > 0xFF, 'V')
-            if output >= 0xA0:
-                output += 0x60
-            self._set_if_true(output >= 0x100, 'C')
-            output &= 0xFF
-            self._set_if_true(output & 0x80, 'N')
-            self._set_if_true(output == 0, 'Z')
-
-            # if self.P & Status['C']:
-            #     carry = 1
-            # else:
-            #     carry = 0
-            # intermediate = (self.A & 0x0F) - (operand & 0x0F) + carry - 1
-            #
-            # if intermediate < 0x00:
-            #     intermediate = ((intermediate - 0x06) & 0x0F) - 0x10
-            #
-            # output = (self.A & 0xF0) - (operand & 0xF0) + intermediate
-            # self._set_if_true(output < -127, 'V')
-            # if output < 0x00:
-            #     output -= 0x60
-            # self._set_if_true(output >= 0x100, 'C')
-            # output &= 0xFF
-            # self._set_if_true(output & 0x80, 'N')
-            # self._set_if_true(output == 0, 'Z')
         else:
             operand ^= 0xFF  # Invert bits then add
-            if self.P & Status['C']:
-                carry = 1
-            else:
-                carry = 0
-            output = self.A + operand + carry
-
-            # Set Flags
-            self._set_if_true(output > 0xFF, 'C')
-            output &= 0xFF
-            self._set_if_true(output == 0, 'Z')
-            self._set_if_true(output & 0x80, 'N')
-            v_flag = 0
-            if self.A & 0x80:
-                v_flag += 1
-            if operand & 0x80:
-                v_flag += 1
-            if output & 0x80:
-                v_flag += 2
-            self._set_if_true(v_flag == 2, 'V')
-        self.A = output
-
-    def op_sec(self, _):
-        self.P |= Status['C']
-
-    def op_sed(self, _):
-        self.P |= Status['D']
-
-    def op_sei(self, _):
-        self.P |= Status['I']
-
-    def op_smb0(self, address_func):
-        address, operand, _ = address_func()
-        n = 0
-        operand = operand | (1 << n)
-        self.bus[address] = operand
-
-    def op_smb1(self, address_func):
-        address, operand, _ = address_func()
-        n = 1
-        operand = operand | (1 << n)
-        self.bus[address] = operand
-
-    def op_smb2(self, address_func):
-        address, operand, _ = address_func()
-        n = 2
-        operand = operand | (1 << n)
-        self.bus[address] = operand
-
-    def op_smb3(self, address_func):
-        address, operand, _ = address_func()
-        n = 3
-        operand = operand | (1 << n)
-        self.bus[address] = operand
-
-    def op_smb4(self, address_func):
-        address, operand, _ = address_func()
-        n = 4
-        operand = operand | (1 << n)
-        self.bus[address] = operand
-
-    def op_smb5(self, address_func):
-        address, operand, _ = address_func()
-        n = 5
-        operand = operand | (1 << n)
-        self.bus[address] = operand
-
-    def op_smb6(self, address_func):
-        address, operand, _ = address_func()
-        n = 6
-        operand = operand | (1 << n)
-        self.bus[address] = operand
-
-    def op_smb7(self, address_func):
-        address, operand, _ = address_func()
-        n = 7
-        operand = operand | (1 << n)
-        self.bus[address] = operand
-
-    def op_sta(self, address_func):
-        address, _, _ = address_func()
-        self.bus[address] = self.A
-
-    @staticmethod
-    def op_stp(_):
-        print('STP Called')
-
-    def op_stx(self, address_func):
-        address, _, _ = address_func()
-        self.bus[address] = self.X
-
-    def op_sty(self, address_func):
-        address, _, _ = address_func()
-        self.bus[address] = self.Y
-
-    def op_stz(self, address_func):
-        address, _, _ = address_func()
-        self.bus[address] = 0
-
-    def op_tax(self, _):
-        self._set_if_true(self.A == 0, 'Z')
-        self._set_if_true(self.A & 0x80, 'N')
-        self.X = self.A
-
-    def op_tay(self, _):
-        self._set_if_true(self.A == 0, 'Z')
-        self._set_if_true(self.A & 0x80, 'N')
-        self.Y = self.A
-
-    def op_trb(self, address_func):
-        address, operand, _ = address_func()
-        self._set_if_true((operand & self.A) == 0, 'Z')
-        operand &= ~self.A
-        self.bus[address] = operand
-
-    def op_tsb(self, address_func):
-        address, operand, _ = address_func()
-        self._set_if_true((operand & self.A) == 0, 'Z')
-        operand |= self.A
-        self.bus[address] = operand
-
-    def op_tsx(self, _):
-        self._set_if_true(self.S == 0, 'Z')
-        self._set_if_true(self.S & 0x80, 'N')
-        self.X = self.S
-
-    def op_txa(self, _):
-        self._set_if_true(self.X == 0, 'Z')
-        self._set_if_true(self.X & 0x80, 'N')
-        self.A = self.X
-
-    def op_txs(self, _):
-        self.S = self.X
-
-    def op_tya(self, _):
-        self._set_if_true(self.Y == 0, 'Z')
-        self._set_if_true(self.Y & 0x80, 'N')
-        self.A = self.Y
-
-    @staticmethod
-    def op_wai(_):
-        print('WAI CALLED')
-
-    @staticmethod
-    def op_xxx(address_func):
-        _, _, _ = address_func()  # Eat up required bytes
-        print('XXX CALLED')
-
-
-class Address6502(abc.ABC):
-
-    def __init__(self, bus):
-        self.A = 0
-        self.X = 0
-        self.Y = 0
-        self.S = 0
-        self.PC = 0
-        self.bus = bus
-
-    @abc.abstractmethod
-    def _read_pc(self): pass
-
-    @abc.abstractmethod
-    def _read_bytes_pc(self, length): pass
-
-    @abc.abstractmethod
-    def _pop_stack(self): pass
-
-    @abc.abstractmethod
-    def _push_stack(self, val): pass
-
-    @property
-    @abc.abstractmethod
-    def zero_page_bug(self): pass
-
-    def absolute(self):
-        address = self._read_bytes_pc(2)
-        address = address[0] + (address[1] << 8)
-        return address, self.bus[address], False
-
-    def absolute_x(self):
-        address, _, _ = self.absolute()
-        address_out = address + self.X
-        if (address_out & 0xFF00) != (address & 0xFF00):
-            extra_cycle = True
+        ''') + textwrap.dedent(_ADD)),
+    'sec': (False, 'cpu._p |= {C}'),
+    'sed': (False, 'cpu._p |= {D}'),
+    'sei': (False, 'cpu._p |= {I}'),
+    'sta': (False, '{store} = cpu.A'),
+    'stp': (False, "print('STP Called')"),
+    'stx': (False, '{store} = cpu.X'),
+    'sty': (False, '{store} = cpu.Y'),
+    'stz': (False, '{store} = 0'),
+    'tax': (False, _LOAD.format(register='cpu.X', value='cpu.A')),
+    'tay': (False, _LOAD.format(register='cpu.Y', value='cpu.A')),
+    'trb': (True, '''
+        result = operand & cpu.A
+        {set_z}
+        {store} = operand & ~cpu.A
+        '''),
+    'tsb': (True, '''
+        result = operand & cpu.A
+        {set_z}
+        {store} = operand | cpu.A
+        '''),
+    'tsx': (False, _LOAD.format(register='cpu.X', value='cpu.S')),
+    'txa': (False, _LOAD.format(register='cpu.A', value='cpu.X')),
+    'txs': (False, 'cpu.S = cpu.X'),
+    'tya': (False, _LOAD.format(register='cpu.A', value='cpu.Y')),
+    'wai': (False, '''
+        cpu.waiting = True
+        cpu.deadline = 0
+        '''),
+    'xxx': (False, "print('XXX CALLED')"),
+}
+
+for _n in range(8):
+    _OPERATIONS[f'bbr{_n}'] = (False, f'if not operand & {1 << _n:#04x}:\n    cpu.PC = address')
+    _OPERATIONS[f'bbs{_n}'] = (False, f'if operand & {1 << _n:#04x}:\n    cpu.PC = address')
+    _OPERATIONS[f'rmb{_n}'] = (True, f'{{store}} = operand & {0xFF ^ (1 << _n):#04x}')
+    _OPERATIONS[f'smb{_n}'] = (True, f'{{store}} = operand | {1 << _n:#04x}')
+
+for _name, _condition in (('bcc', 'not cpu._p & {C}'), ('bcs', 'cpu._p & {C}'),
+                          ('beq', '{z_set}'), ('bne', '{z_clear}'),
+                          ('bmi', '{n_set}'), ('bpl', '{n_clear}'),
+                          ('bvc', 'not cpu._p & {V}'), ('bvs', 'cpu._p & {V}')):
+    _OPERATIONS[_name] = (False, _BRANCH.format(condition=_condition))
+
+# Operations that take an extra cycle when indexing crosses a page
+_PAGE_PENALTY = {'adc', 'and', 'cmp', 'eor', 'lda', 'ldx', 'ldy', 'ora', 'sbc'}
+
+# Operations that may jump backwards into an idle loop
+_IDLE_EXITS = {'bbr0', 'bbr1', 'bbr2', 'bbr3', 'bbr4', 'bbr5', 'bbr6', 'bbr7',
+               'bbs0', 'bbs1', 'bbs2', 'bbs3', 'bbs4', 'bbs5', 'bbs6', 'bbs7',
+               'bcc', 'bcs', 'beq', 'bmi', 'bne', 'bpl', 'bra', 'bvc', 'bvs', 'jmp'}
+
+# Operations allowed inside an idle loop: they change nothing but registers and flags
+_IDLE_SAFE = _IDLE_EXITS | {'adc', 'and', 'bit', 'clc', 'cld', 'clv', 'cmp', 'cpx', 'cpy', 'dex', 'dey',
+                            'eor', 'inx', 'iny', 'lda', 'ldx', 'ldy', 'nop', 'ora', 'sbc', 'sec', 'sed',
+                            'tax', 'tay', 'tsx', 'txa', 'tya'}
+_IDLE_LENGTH = 16   # Longest loop, in bytes, checked for idling
+
+
+def _instruction_source(operation, mode, b1, b2, next_pc, flags=_EAGER_FLAGS, set_pc=True, idle=False):
+    """Source for a single instruction with its addressing mode inlined. With idle set, backward jumps
+    call cpu._idle_loop() to look for a loop that can be skipped"""
+    reads, op_source = _OPERATIONS[operation]
+    _, mode_source, _ = _MODES[mode]
+    lines = [textwrap.dedent(mode_source).format(b1=b1, b2=b2, next=next_pc).strip()]
+    if set_pc and next_pc != 'cpu.PC':
+        lines.append(f'cpu.PC = {next_pc}')
+    if reads and mode not in _OPERAND_MODES:
+        if mode in _ZERO_PAGE_MODES:
+            lines.append('operand = rp[0][address]')
         else:
-            extra_cycle = False
-        return address_out, self.bus[address_out], extra_cycle
-
-    def absolute_indirect_x(self):
-        address, _, _ = self.absolute_x()
-        if self.zero_page_bug and ((address & 0x00FF) == 0xFF):
-            address_out = (self.bus[address & 0xFF00] << 8) | self.bus[address]
-        else:
-            address_out = (self.bus[address + 1] << 8) | self.bus[address]
-        return address_out, self.bus[address_out], False
-
-    def absolute_y(self):
-        address, _, _ = self.absolute()
-        address_out = address + self.Y
-        if (address_out & 0xFF00) != (address & 0xFF00):
-            extra_cycle = True
-        else:
-            extra_cycle = False
-        return address_out, self.bus[address_out], extra_cycle
-
-    def accumulator(self):
-        return 'ACCUMULATOR', self.A, False
-
-    def immediate(self):
-        out = self._read_pc()
-        return self.PC, out, False
-
-    @staticmethod
-    def implied():
-        return None, None, False
-
-    def indirect(self):
-        address, _, _ = self.absolute()
-        if self.zero_page_bug and ((address & 0x00FF) == 0xFF):
-            address_out = (self.bus[address & 0xFF00] << 8) | self.bus[address]
-        else:
-            address_out = (self.bus[address + 1] << 8) | self.bus[address]
-        return address_out, self.bus[address_out], False
-    
-    def relative(self):
-        offset = self._read_pc()
-        if offset & 0x80:
-            offset -= (1 << 8)
-        address_out = self.PC + offset
-        return address_out, self.bus[address_out], False
-
-    def stack(self):
-        return 0x0100 + self.S, self.bus[self.S], False
-
-    def zero_page(self):
-        address_out = self._read_pc()
-        return address_out, self.bus[address_out], False
-
-    def zero_page_relative(self):
-        _, operand, _ = self.zero_page()
-        address, _, _ = self.relative()
-        return address, operand, False
-
-    def zero_page_x(self):
-        address, _, _ = self.zero_page()
-        address_out = (address + self.X) & 0x00FF
-        return address_out, self.bus[address_out], False
-
-    def zero_page_y(self):
-        address, _, _ = self.zero_page()
-        address_out = (address + self.Y) & 0x00FF
-        return address_out, self.bus[address_out], False
-
-    def zero_page_indirect(self):
-        address, _, _ = self.zero_page()
-        if (address & 0x00FF) == 0xFF:
-            address_out = (self.bus[address & 0xFF00] << 8) | self.bus[address]
-        else:
-            address_out = (self.bus[address + 1] << 8) | self.bus[address]
-        return address_out, self.bus[address_out], False
-
-    def zero_page_indirect_x(self):
-        address, _, _ = self.zero_page_x()
-        if (address & 0x00FF) == 0xFF:
-            address_out = (self.bus[address & 0xFF00] << 8) | self.bus[address]
-        else:
-            address_out = (self.bus[address + 1] << 8) | self.bus[address]
-        return address_out, self.bus[address_out], False
-
-    def zero_page_indirect_y(self):
-        address, _, _ = self.zero_page()
-        if (address & 0x00FF) == 0xFF:
-            address_out = ((self.bus[address & 0xFF00] << 8) | self.bus[address]) + self.Y
-        else:
-            address_out = ((self.bus[address + 1] << 8) | self.bus[address]) + self.Y
-        return address_out, self.bus[address_out], False
-
-    def address_lengths(self, func):
-        lengths = {
-            self.absolute: 2,
-            self.absolute_indirect_x: 2,
-            self.absolute_x: 2,
-            self.absolute_y: 2,
-            self.accumulator: 0,
-            self.immediate: 1,
-            self.implied: 0,
-            self.indirect: 2,
-            self.relative: 1,
-            self.stack: 0,
-            self.zero_page: 1,
-            self.zero_page_relative: 2,
-            self.zero_page_indirect: 1,
-            self.zero_page_indirect_x: 1,
-            self.zero_page_indirect_y: 1,
-            self.zero_page_x: 1,
-            self.zero_page_y: 1,
-        }
-        return lengths[func]
-
-    @staticmethod
-    def _twos_complement(val):
-        if val & 0x80:
-            return val - (1 << 8)
+            lines.append('operand = rp[address >> 8][address & 0xFF]')
+    if operation in _PAGE_PENALTY and mode in _PAGE_PENALTY_MODES:
+        lines.append('if (address ^ base) & 0xFF00:\n    cycles += 1')
+    if mode == 'accumulator':
+        store = 'cpu.A'
+    elif mode in _ZERO_PAGE_MODES:
+        store = 'wp[0][address]'
+    else:
+        store = 'wp[address >> 8][address & 0xFF]'
+    lines.append(textwrap.dedent(op_source).format(store=store, **flags, **Status.values).strip())
+    if idle and operation in _IDLE_EXITS:
+        lines.append(f'if cpu.PC < {next_pc}:\n    cycles += cpu._idle_loop({next_pc})')
+    return '\n'.join(line for line in lines if line)
+
+
+def _handler_source(name, operation, mode, cycles, flags, idle):
+    """Source for a handler that executes one opcode and returns the cycles it took"""
+    length = _MODES[mode][0]
+    body = _instruction_source(operation, mode,
+                               b1='rp[pc >> 8][pc & 0xFF]',
+                               b2='rp[(pc + 1) >> 8][(pc + 1) & 0xFF]',
+                               next_pc=f'pc + {length}' if length else 'cpu.PC',
+                               flags=flags, idle=idle)
+    prologue = [f'cycles = {cycles}']
+    if length:
+        prologue.insert(0, 'pc = cpu.PC')
+    return _function_source(name, prologue, body)
+
+
+def _function_source(name, prologue, body):
+    if 'wp[' in body:
+        prologue.insert(0, 'wp = cpu._write_pages')
+    if 'rp[' in body:
+        prologue.insert(0, 'rp = cpu._read_pages')
+    body = '\n'.join(prologue) + '\n' + body + '\nreturn cycles'
+    return f'def {name}(cpu):\n' + textwrap.indent(body, '    ') + '\n'
+
+
+def _build_handlers(matrix, flags=_EAGER_FLAGS, idle=False):
+    """Compiles one handler per opcode, shared by every Cpu6502 instance"""
+    names = [f'_op_{code:02X}' for code in range(len(matrix))]
+    source = '\n\n'.join(_handler_source(name, *entry, flags, idle) for name, entry in zip(names, matrix))
+    namespace = {}
+    exec(compile(source, '<cpu6502 handlers>', 'exec'), namespace)
+    return tuple(namespace[name] for name in names)
+
+
+# Operations that end a basic block
+_BLOCK_END = {'bbr0', 'bbr1', 'bbr2', 'bbr3', 'bbr4', 'bbr5', 'bbr6', 'bbr7',
+              'bbs0', 'bbs1', 'bbs2', 'bbs3', 'bbs4', 'bbs5', 'bbs6', 'bbs7',
+              'bcc', 'bcs', 'beq', 'bmi', 'bne', 'bpl', 'bra', 'brk', 'bvc', 'bvs',
+              'jmp', 'jsr', 'rti', 'rts', 'stp', 'wai', 'xxx'}
+
+
+class BlockCache:
+    """Compiles frequently executed straight-line code into one Python function per basic block.
+
+    Blocks are keyed by their start address. The pages holding compiled code are watched on the bus and
+    a write to any compiled byte throws away every block in that page, so self-modifying code still
+    runs correctly. A block sets PC before each of its stores and exits early after one that wrote to
+    compiled code, in case it modified one of its own later instructions, or that raised an interrupt.
+    """
+    threshold = 8       # Visits to an address before a block is compiled there
+    max_length = 32     # Instructions per block
+
+    def __init__(self, cpu):
+        self.cpu = cpu
+        self.blocks = dict()
+        self._visits = dict()
+        self._page_blocks = dict()   # Page: start addresses of blocks with code in it
+        self._code = dict()          # Page: bytearray marking bytes that belong to compiled blocks
+
+    def miss(self, pc):
+        """Called for an address with no block. Returns a newly compiled block once pc is hot"""
+        visits = self._visits.get(pc, 0) + 1
+        self._visits[pc] = visits
+        if visits < self.threshold:
+            return None
+        return self.compile(pc)
+
+    def compile(self, start):
+        bus = self.cpu.bus
+        matrix = self.cpu.matrix
+        flags = _LAZY_FLAGS if self.cpu.lazy_flags else _EAGER_FLAGS
+        body = []
+        address = start
+        for number in range(self.max_length):
+            try:
+                operation, mode, cycles = matrix[bus[address]]
+                data = [bus[address + 1 + n] for n in range(_MODES[mode][0])]
+            except IndexError:
+                break
+            next_pc = address + 1 + len(data)
+            last = operation in _BLOCK_END or number == self.max_length - 1
+            b1, b2 = (f'{value:#04x}' for value in data + [0, 0][len(data):])
+            source = _instruction_source(operation, mode, b1, b2, f'{next_pc:#06x}', flags, set_pc=last,
+                                         idle=self.cpu.skip_idle)
+            body += [f'# {address:04X}', f'cycles += {cycles}']
+            if not last and 'wp[' in source:
+                # A store can reach a device that interrupts, so PC has to be right before it and the block
+                # has to stop if the interrupt was taken
+                body += [f'cpu.PC = {next_pc:#06x}', source,
+                         f'if cpu.PC != {next_pc:#06x} or cpu.code_written:\n'
+                         f'    cpu.code_written = False\n'
+                         f'    return cycles']
+            else:
+                body.append(source)
+            self._mark(start, address, next_pc)
+            address = next_pc
+            if last:
+                break
+        if address == start:
+            return None
+        namespace = dict()
+        name = f'_block_{start:04X}'
+        exec(compile(_function_source(name, ['cycles = 0'], '\n'.join(body)), f'<block {start:04X}>', 'exec'),
+             namespace)
+        self.blocks[start] = namespace[name]
+        return self.blocks[start]
+
+    def _mark(self, start, first, stop):
+        for address in range(first, stop):
+            page = address >> 8
+            if page not in self._code:
+                self._code[page] = bytearray(0x100)
+                self._page_blocks[page] = set()
+                self.cpu.bus.watch(page, self._written)
+            self._code[page][address & 0xFF] = 1
+            self._page_blocks[page].add(start)
+
+    def _written(self, page, index):
+        code = self._code.get(page)
+        if code is None or index is not None and not code[index]:
+            return
+        for start in self._page_blocks.pop(page):
+            self.blocks.pop(start, None)
+            self._visits.pop(start, None)
+        del self._code[page]
+        self.cpu.bus.unwatch(page, self._written)
+        self.cpu.code_written = True
+
+    def clear(self):
+        for page in list(self._code):
+            self._written(page, None)
+
+
+# Machine state from Cpu6502.snapshot(): register values and the bus device states
+Snapshot = namedtuple('Snapshot', 'registers devices')
+
+
+class DisassemblyCache:
+    """Keeps the disassembly of every instruction decoded so far. Pages holding cached instructions are
+    watched on the bus and an entry is dropped as soon as one of its bytes is written or remapped"""
+
+    def __init__(self, cpu):
+        self.cpu = cpu
+        self.lines = dict()     # Address: (text, length)
+        self._pages = dict()    # Page: addresses of cached instructions with bytes in it
+
+    def get(self, address):
+        line = self.lines.get(address)
+        if line is None:
+            line = self.lines[address] = self.decode(address)
+            for page in range(address >> 8, ((address + line[1] - 1) >> 8) + 1):
+                if page not in self._pages:
+                    self._pages[page] = set()
+                    self.cpu.bus.watch(page, self._written)
+                self._pages[page].add(address)
+        return line
+
+    def decode(self, address):
+        cpu = self.cpu
+        operation, mode, _ = cpu.matrix[cpu.bus[address]]
+        length = _MODES[mode][0]
+        operands = [cpu.bus[address + 1 + n] for n in range(length)]
+        name = operation.split('_')[0].upper()
+        return f'{address:04X}:    {name} {cpu.address_text(mode, operands, address)}', length + 1
+
+    def _written(self, page, index):
+        addresses = self._pages.get(page, ())
+        if index is None:
+            stale = set(addresses)
         else:
-            return val
-
-    def address_text(self, func, text, pc):
-        mapping = {
-            self.absolute: '${1:02X}{0:02X} [a]',
-            self.absolute_indirect_x: '$({1:02X}{0:02X}, X) [(a,x)]',
-            self.absolute_x: '${1:02X}{0:02X}, X [a, x]',
-            self.absolute_y: '${1:02X}{0:02X}, Y [a, y]',
-            self.accumulator: '[Acc]',
-            self.immediate: '#{0:02X} [Imm]',
-            self.implied: '[Imp]',
-            self.indirect: '$({1:02X}{0:02X}) [(a)]',
-            self.relative: '-> {{{0:04X}}} [Rel]',
-            self.stack: '[Sta]',
-            self.zero_page: '${0:02X} [zp]',
-            self.zero_page_relative: '${0:02X} -> {{{1:04X}}} [zp Rel]',
-            self.zero_page_indirect: '$({0:02X}) [(zp)]',
-            self.zero_page_indirect_x: '$({0:02X}, X) [(zp, x)]',
-            self.zero_page_indirect_y: '(${0:02X}), Y [(zp), y]',
-            self.zero_page_x: '${0:02X}, X [zp, x]',
-            self.zero_page_y: '${0:02X}, Y [zp, y]',
-        }
-        if func == self.relative:
-            text[0] = pc + self.address_lengths(func) + 1 + self._twos_complement(text[0])
-        elif func == self.zero_page_relative:
-            text[1] = pc + self.address_lengths(func) + 1 + self._twos_complement(text[1])
-        return mapping[func].format(*text)
-
-
-class Cpu6502(Address6502, Ops6502):
-
-    # noinspection PyMissingConstructor
-    def __init__(self, bus, zero_page_bug=True):
+            written = page << 8 | index
+            stale = {address for address in range(written - 2, written + 1) if address in addresses and
+                     address + self.lines[address][1] > written}
+        for address in stale:
+            _, length = self.lines.pop(address)
+            for other in range(address >> 8, ((address + length - 1) >> 8) + 1):
+                self._pages[other].discard(address)
+                if not self._pages[other]:
+                    del self._pages[other]
+                    self.cpu.bus.unwatch(other, self._written)
+
+    def clear(self):
+        for page in list(self._pages):
+            if page in self._pages:
+                self._written(page, None)
+
+
+class Cpu6502:
+
+    # Opcode: (operation, addressing mode, cycles)
+    matrix = (
+        ('brk', 'stack', 7),                  # 00
+        ('ora', 'zero_page_indirect_x', 6),   # 01
+        ('xxx', 'immediate', 0),              # 02
+        ('xxx', 'implied', 0),                # 03
+        ('tsb', 'zero_page', 5),              # 04
+        ('ora', 'zero_page', 3),              # 05
+        ('asl', 'zero_page', 5),              # 06
+        ('rmb0', 'zero_page', 5),             # 07
+        ('php', 'stack', 3),                  # 08
+        ('ora', 'immediate', 2),              # 09
+        ('asl', 'accumulator', 2),            # 0A
+        ('xxx', 'implied', 0),                # 0B
+        ('tsb', 'absolute', 6),               # 0C
+        ('ora', 'absolute', 4),               # 0D
+        ('asl', 'absolute', 6),               # 0E
+        ('bbr0', 'zero_page_relative', 5),    # 0F
+
+        ('bpl', 'relative', 2),               # 10
+        ('ora', 'zero_page_indirect_y', 5),   # 11
+        ('ora', 'zero_page_indirect', 5),     # 12
+        ('xxx', 'implied', 0),                # 13
+        ('trb', 'zero_page', 5),              # 14
+        ('ora', 'zero_page_x', 4),            # 15
+        ('asl', 'zero_page_x', 6),            # 16
+        ('rmb1', 'zero_page', 5),             # 17
+        ('clc', 'implied', 2),                # 18
+        ('ora', 'absolute_y', 4),             # 19
+        ('inc', 'accumulator', 2),            # 1A
+        ('xxx', 'implied', 0),                # 1B
+        ('trb', 'absolute', 6),               # 1C
+        ('ora', 'absolute_x', 4),             # 1D
+        ('asl', 'absolute_x', 7),             # 1E
+        ('bbr1', 'zero_page_relative', 5),    # 1F
+
+        ('jsr', 'absolute', 6),               # 20
+        ('and', 'zero_page_indirect_x', 6),   # 21
+        ('xxx', 'immediate', 0),              # 22
+        ('xxx', 'implied', 0),                # 23
+        ('bit', 'zero_page', 3),              # 24
+        ('and', 'zero_page', 3),              # 25
+        ('rol', 'zero_page', 5),              # 26
+        ('rmb2', 'zero_page', 5),             # 27
+        ('plp', 'stack', 4),                  # 28
+        ('and', 'immediate', 2),              # 29
+        ('rol', 'accumulator', 2),            # 2A
+        ('xxx', 'implied', 0),                # 2B
+        ('bit', 'absolute', 4),               # 2C
+        ('and', 'absolute', 4),               # 2D
+        ('rol', 'absolute', 6),               # 2E
+        ('bbr2', 'zero_page_relative', 5),    # 2F
+
+        ('bmi', 'relative', 2),               # 30
+        ('and', 'zero_page_indirect_y', 5),   # 31
+        ('and', 'zero_page_indirect', 5),     # 32
+        ('xxx', 'implied', 0),                # 33
+        ('bit', 'zero_page_x', 4),            # 34
+        ('and', 'zero_page_x', 4),            # 35
+        ('rol', 'zero_page_x', 6),            # 36
+        ('rmb3', 'zero_page', 5),             # 37
+        ('sec', 'implied', 2),                # 38
+        ('and', 'absolute_y', 4),             # 39
+        ('dec', 'accumulator', 2),            # 3A
+        ('xxx', 'implied', 0),                # 3B
+        ('bit', 'absolute_x', 4),             # 3C
+        ('and', 'absolute_x', 4),             # 3D
+        ('rol', 'absolute_x', 7),             # 3E
+        ('bbr3', 'zero_page_relative', 5),    # 3F
+
+        ('rti', 'stack', 6),                  # 40
+        ('eor', 'zero_page_indirect_x', 6),   # 41
+        ('xxx', 'immediate', 0),              # 42
+        ('xxx', 'implied', 0),                # 43
+        ('xxx', 'immediate', 0),              # 44
+        ('eor', 'zero_page', 3),              # 45
+        ('lsr', 'zero_page', 5),              # 46
+        ('rmb4', 'zero_page', 5),             # 47
+        ('pha', 'stack', 3),                  # 48
+        ('eor', 'immediate', 2),              # 49
+        ('lsr', 'accumulator', 2),            # 4A
+        ('xxx', 'implied', 0),                # 4B
+        ('jmp', 'absolute', 3),               # 4C
+        ('eor', 'absolute', 4),               # 4D
+        ('lsr', 'absolute', 6),               # 4E
+        ('bbr4', 'zero_page_relative', 5),    # 4F
+
+        ('bvc', 'relative', 2),               # 50
+        ('eor', 'zero_page_indirect_y', 5),   # 51
+        ('eor', 'zero_page_indirect', 5),     # 52
+        ('xxx', 'implied', 0),                # 53
+        ('xxx', 'immediate', 0),              # 54
+        ('eor', 'zero_page_x', 4),            # 55
+        ('lsr', 'zero_page_x', 6),            # 56
+        ('rmb5', 'zero_page', 5),             # 57
+        ('cli', 'implied', 2),                # 58
+        ('eor', 'absolute_y', 4),             # 59
+        ('phy', 'stack', 3),                  # 5A
+        ('xxx', 'implied', 0),                # 5B
+        ('xxx', 'absolute', 0),               # 5C
+        ('eor', 'absolute_x', 4),             # 5D
+        ('lsr', 'absolute_x', 7),             # 5E
+        ('bbr5', 'zero_page_relative', 5),    # 5F
+
+        ('rts', 'stack', 6),                  # 60
+        ('adc', 'zero_page_indirect_x', 6),   # 61
+        ('xxx', 'immediate', 0),              # 62
+        ('xxx', 'implied', 0),                # 63
+        ('stz', 'zero_page', 3),              # 64
+        ('adc', 'zero_page', 3),              # 65
+        ('ror', 'zero_page', 5),              # 66
+        ('rmb6', 'zero_page', 5),             # 67
+        ('pla', 'stack', 4),                  # 68
+        ('adc', 'immediate', 2),              # 69
+        ('ror', 'accumulator', 2),            # 6A
+        ('xxx', 'implied', 0),                # 6B
+        ('jmp', 'indirect', 6),               # 6C
+        ('adc', 'absolute', 4),               # 6D
+        ('ror', 'absolute', 6),               # 6E
+        ('bbr6', 'zero_page_relative', 5),    # 6F
+
+        ('bvs', 'relative', 2),               # 70
+        ('adc', 'zero_page_indirect_y', 5),   # 71
+        ('adc', 'zero_page_indirect', 5),     # 72
+        ('xxx', 'implied', 0),                # 73
+        ('stz', 'zero_page_x', 4),            # 74
+        ('adc', 'zero_page_x', 4),            # 75
+        ('ror', 'zero_page_x', 6),            # 76
+        ('rmb7', 'zero_page', 5),             # 77
+        ('sei', 'implied', 2),                # 78
+        ('adc', 'absolute_y', 4),             # 79
+        ('ply', 'stack', 4),                  # 7A
+        ('xxx', 'implied', 0),                # 7B
+        ('jmp', 'absolute_indirect_x', 6),    # 7C
+        ('adc', 'absolute_x', 4),             # 7D
+        ('ror', 'absolute_x', 7),             # 7E
+        ('bbr7', 'zero_page_relative', 5),    # 7F
+
+        ('bra', 'relative', 3),               # 80
+        ('sta', 'zero_page_indirect_x', 6),   # 81
+        ('xxx', 'immediate', 0),              # 82
+        ('xxx', 'implied', 0),                # 83
+        ('sty', 'zero_page', 3),              # 84
+        ('sta', 'zero_page', 3),              # 85
+        ('stx', 'zero_page', 3),              # 86
+        ('smb0', 'zero_page', 5),             # 87
+        ('dey', 'implied', 2),                # 88
+        ('bit_imm', 'immediate', 2),          # 89
+        ('txa', 'implied', 2),                # 8A
+        ('xxx', 'implied', 0),                # 8B
+        ('sty', 'absolute', 4),               # 8C
+        ('sta', 'absolute', 4),               # 8D
+        ('stx', 'absolute', 4),               # 8E
+        ('bbs0', 'zero_page_relative', 5),    # 8F
+
+        ('bcc', 'relative', 2),               # 90
+        ('sta', 'zero_page_indirect_y', 6),   # 91
+        ('sta', 'zero_page_indirect', 5),     # 92
+        ('xxx', 'implied', 0),                # 93
+        ('sty', 'zero_page_x', 4),            # 94
+        ('sta', 'zero_page_x', 4),            # 95
+        ('stx', 'zero_page_y', 4),            # 96
+        ('smb1', 'zero_page', 5),             # 97
+        ('tya', 'implied', 2),                # 98
+        ('sta', 'absolute_y', 5),             # 99
+        ('txs', 'implied', 2),                # 9A
+        ('xxx', 'implied', 0),                # 9B
+        ('stz', 'absolute', 4),               # 9C
+        ('sta', 'absolute_x', 5),             # 9D
+        ('stz', 'absolute_x', 5),             # 9E
+        ('bbs1', 'zero_page_relative', 5),    # 9F
+
+        ('ldy', 'immediate', 2),              # A0
+        ('lda', 'zero_page_indirect_x', 6),   # A1
+        ('ldx', 'immediate', 2),              # A2
+        ('xxx', 'implied', 0),                # A3
+        ('ldy', 'zero_page', 3),              # A4
+        ('lda', 'zero_page', 3),              # A5
+        ('ldx', 'zero_page', 3),              # A6
+        ('smb2', 'zero_page', 5),             # A7
+        ('tay', 'implied', 2),                # A8
+        ('lda', 'immediate', 2),              # A9
+        ('tax', 'implied', 2),                # AA
+        ('xxx', 'implied', 0),                # AB
+        ('ldy', 'absolute', 4),               # AC
+        ('lda', 'absolute', 5),               # AD
+        ('ldx', 'absolute', 5),               # AE
+        ('bbs2', 'zero_page_relative', 5),    # AF
+
+        ('bcs', 'relative', 2),               # B0
+        ('lda', 'zero_page_indirect_y', 5),   # B1
+        ('lda', 'zero_page_indirect', 5),     # B2
+        ('xxx', 'implied', 0),                # B3
+        ('ldy', 'zero_page_x', 4),            # B4
+        ('lda', 'zero_page_x', 4),            # B5
+        ('ldx', 'zero_page_y', 4),            # B6
+        ('smb3', 'zero_page', 5),             # B7
+        ('clv', 'implied', 2),                # B8
+        ('lda', 'absolute_y', 2),             # B9
+        ('tsx', 'implied', 2),                # BA
+        ('xxx', 'implied', 0),                # BB
+        ('ldy', 'absolute_x', 4),             # BC
+        ('lda', 'absolute_x', 4),             # BD
+        ('ldx', 'absolute_y', 4),             # BE
+        ('bbs3', 'zero_page_relative', 5),    # BF
+
+        ('cpy', 'immediate', 2),              # C0
+        ('cmp', 'zero_page_indirect_x', 6),   # C1
+        ('xxx', 'immediate', 0),              # C2
+        ('xxx', 'implied', 0),                # C3
+        ('cpy', 'zero_page', 3),              # C4
+        ('cmp', 'zero_page', 3),              # C5
+        ('dec', 'zero_page', 5),              # C6
+        ('smb4', 'zero_page', 5),             # C7
+        ('iny', 'implied', 2),                # C8
+        ('cmp', 'immediate', 2),              # C9
+        ('dex', 'implied', 2),                # CA
+        ('wai', 'implied', 0),                # CB
+        ('cpy', 'absolute', 4),               # CC
+        ('cmp', 'absolute', 4),               # CD
+        ('dec', 'absolute', 6),               # CE
+        ('bbs4', 'zero_page_relative', 5),    # CF
+
+        ('bne', 'relative', 2),               # D0
+        ('cmp', 'zero_page_indirect_y', 5),   # D1
+        ('cmp', 'zero_page_indirect', 5),     # D2
+        ('xxx', 'implied', 0),                # D3
+        ('xxx', 'immediate', 0),              # D4
+        ('cmp', 'zero_page_x', 4),            # D5
+        ('dec', 'zero_page_x', 6),            # D6
+        ('smb5', 'zero_page', 5),             # D7
+        ('cld', 'implied', 2),                # D8
+        ('cmp', 'absolute_y', 4),             # D9
+        ('phx', 'stack', 3),                  # DA
+        ('stp', 'implied', 0),                # DB
+        ('xxx', 'absolute', 0),               # DC
+        ('cmp', 'absolute_x', 4),             # DD
+        ('dec', 'absolute_x', 7),             # DE
+        ('bbs5', 'zero_page_relative', 5),    # DF
+
+        ('cpx', 'immediate', 2),              # E0
+        ('sbc', 'zero_page_indirect_x', 6),   # E1
+        ('xxx', 'immediate', 0),              # E2
+        ('xxx', 'implied', 0),                # E3
+        ('cpx', 'zero_page', 3),              # E4
+        ('sbc', 'zero_page', 3),              # E5
+        ('inc', 'zero_page', 5),              # E6
+        ('smb6', 'zero_page', 5),             # E7
+        ('inx', 'implied', 2),                # E8
+        ('sbc', 'immediate', 2),              # E9
+        ('nop', 'implied', 2),                # EA
+        ('xxx', 'implied', 0),                # EB
+        ('cpx', 'absolute', 4),               # EC
+        ('sbc', 'absolute', 4),               # ED
+        ('inc', 'absolute', 6),               # EE
+        ('bbs6', 'zero_page_relative', 5),    # EF
+
+        ('beq', 'relative', 2),               # F0
+        ('sbc', 'zero_page_indirect_y', 5),   # F1
+        ('sbc', 'zero_page_indirect', 5),     # F2
+        ('xxx', 'implied', 0),                # F3
+        ('xxx', 'immediate', 0),              # F4
+        ('sbc', 'zero_page_x', 4),            # F5
+        ('inc', 'zero_page_x', 6),            # F6
+        ('smb7', 'zero_page', 5),             # F7
+        ('sed', 'implied', 2),                # F8
+        ('sbc', 'absolute_y', 4),             # F9
+        ('plx', 'stack', 4),                  # FA
+        ('xxx', 'implied', 0),                # FB
+        ('xxx', 'absolute', 0),               # FC
+        ('sbc', 'absolute_x', 4),             # FD
+        ('inc', 'absolute_x', 7),             # FE
+        ('bbs7', 'zero_page_relative', 5),    # FF
+    )
+
+    handlers = _build_handlers(matrix)
+    _handler_tables = dict()    # (lazy_flags, skip_idle): handlers, for the other variants built so far
+
+    def __init__(self, bus, zero_page_bug=True, lazy_flags=False, compile_blocks=False, skip_idle=False):
         self._zero_page_bug = zero_page_bug
+        self.lazy_flags = lazy_flags
+        self.skip_idle = skip_idle
+        if lazy_flags or skip_idle:
+            key = (lazy_flags, skip_idle)
+            if key not in Cpu6502._handler_tables:
+                flags = _LAZY_FLAGS if lazy_flags else _EAGER_FLAGS
+                Cpu6502._handler_tables[key] = _build_handlers(self.matrix, flags, skip_idle)
+            self.handlers = Cpu6502._handler_tables[key]
         self.bus = bus
         bus.cpu = self
+        self._read_pages = bus.read_pages    # Direct page access, bypassing Bus.__getitem__ for RAM
+        self._write_pages = bus.write_pages
         self.cycles = 0         # Records number of instructions until next instruction read
+        self.total_cycles = 0   # Cycles elapsed since the cpu was created
+        self.deadline = 0       # run() stops here, lowered by the bus when an earlier event is scheduled
+        self.code_written = False   # Set when a write hits compiled code
+        self.waiting = False    # Stopped by WAI until the next interrupt
+        self._idle_state = None     # Registers and cycle stamp at the last backward jump
+        self.block_cache = BlockCache(self) if compile_blocks else None
+        self.disassembly = DisassemblyCache(self)
+        self.hooks = ()         # Called as hook(cpu, pc) before each instruction, see add_hook()
         self.A = 0x00           # Accumulator
         self.X = 0x00           # X register
         self.Y = 0x00           # Y register
-        self.P = Status['UBI']    # Status register
+        self.P = FLAG_U | FLAG_B | FLAG_I   # Status register
         self.PC = 0x0000        # Program Counter register
         self.S = 0xFD           # Stack pointer
 
-        self.matrix = [
-            (self.op_brk, self.stack, 7),                   # 00
-            (self.op_ora, self.zero_page_indirect_x, 6),    # 01
-            (self.op_xxx, self.immediate, 0),               # 02
-            (self.op_xxx, self.implied, 0),                 # 03
-            (self.op_tsb, self.zero_page, 5),               # 04
-            (self.op_ora, self.zero_page, 3),               # 05
-            (self.op_asl, self.zero_page, 5),               # 06
-            (self.op_rmb0, self.zero_page, 5),              # 07
-            (self.op_php, self.stack, 3),                   # 08
-            (self.op_ora, self.immediate, 2),               # 09
-            (self.op_asl, self.accumulator, 2),             # 0A
-            (self.op_xxx, self.implied, 0),                 # 0B
-            (self.op_tsb, self.absolute, 6),                # 0C
-            (self.op_ora, self.absolute, 4),                # 0D
-            (self.op_asl, self.absolute, 6),                # 0E
-            (self.op_bbr0, self.zero_page_relative, 5),     # 0F
-
-            (self.op_bpl, self.relative, 2),                # 10
-            (self.op_ora, self.zero_page_indirect_y, 5),    # 11
-            (self.op_ora, self.zero_page_indirect, 5),      # 12
-            (self.op_xxx, self.implied, 0),                 # 13
-            (self.op_trb, self.zero_page, 5),               # 14
-            (self.op_ora, self.zero_page_x, 4),             # 15
-            (self.op_asl, self.zero_page_x, 6),             # 16
-            (self.op_rmb1, self.zero_page, 5),              # 17
-            (self.op_clc, self.implied, 2),                 # 18
-            (self.op_ora, self.absolute_y, 4),              # 19
-            (self.op_inc, self.accumulator, 2),             # 1A
-            (self.op_xxx, self.implied, 0),                 # 1B
-            (self.op_trb, self.absolute, 6),                # 1C
-            (self.op_ora, self.absolute_x, 4),              # 1D
-            (self.op_asl, self.absolute_x, 7),              # 1E
-            (self.op_bbr1, self.zero_page_relative, 5),     # 1F
-
-            (self.op_jsr, self.absolute, 6),                # 20
-            (self.op_and, self.zero_page_indirect_x, 6),    # 21
-            (self.op_xxx, self.immediate, 0),               # 22
-            (self.op_xxx, self.implied, 0),                 # 23
-            (self.op_bit, self.zero_page, 3),               # 24
-            (self.op_and, self.zero_page, 3),               # 25
-            (self.op_rol, self.zero_page, 5),               # 26
-            (self.op_rmb2, self.zero_page, 5),              # 27
-            (self.op_plp, self.stack, 4),                   # 28
-            (self.op_and, self.immediate, 2),               # 29
-            (self.op_rol, self.accumulator, 2),             # 2A
-            (self.op_xxx, self.implied, 0),                 # 2B
-            (self.op_bit, self.absolute, 4),                # 2C
-            (self.op_and, self.absolute, 4),                # 2D
-            (self.op_rol, self.absolute, 6),                # 2E
-            (self.op_bbr2, self.zero_page_relative, 5),     # 2F
-
-            (self.op_bmi, self.relative, 2),                # 30
-            (self.op_and, self.zero_page_indirect_y, 5),    # 31
-            (self.op_and, self.zero_page_indirect, 5),      # 32
-            (self.op_xxx, self.implied, 0),                 # 33
-            (self.op_bit, self.zero_page_x, 4),             # 34
-            (self.op_and, self.zero_page_x, 4),             # 35
-            (self.op_rol, self.zero_page_x, 6),             # 36
-            (self.op_rmb3, self.zero_page, 5),              # 37
-            (self.op_sec, self.implied, 2),                 # 38
-            (self.op_and, self.absolute_y, 4),              # 39
-            (self.op_dec, self.accumulator, 2),             # 3A
-            (self.op_xxx, self.implied, 0),                 # 3B
-            (self.op_bit, self.absolute_x, 4),              # 3C
-            (self.op_and, self.absolute_x, 4),              # 3D
-            (self.op_rol, self.absolute_x, 7),              # 3E
-            (self.op_bbr3, self.zero_page_relative, 5),     # 3F
-
-            (self.op_rti, self.stack, 6),                   # 40
-            (self.op_eor, self.zero_page_indirect_x, 6),    # 41
-            (self.op_xxx, self.immediate, 0),               # 42
-            (self.op_xxx, self.implied, 0),                 # 43
-            (self.op_xxx, self.immediate, 0),               # 44
-            (self.op_eor, self.zero_page, 3),               # 45
-            (self.op_lsr, self.zero_page, 5),               # 46
-            (self.op_rmb4, self.zero_page, 5),              # 47
-            (self.op_pha, self.stack, 3),                   # 48
-            (self.op_eor, self.immediate, 2),               # 49
-            (self.op_lsr, self.accumulator, 2),             # 4A
-            (self.op_xxx, self.implied, 0),                 # 4B
-            (self.op_jmp, self.absolute, 3),                # 4C
-            (self.op_eor, self.absolute, 4),                # 4D
-            (self.op_lsr, self.absolute, 6),                # 4E
-            (self.op_bbr4, self.zero_page_relative, 5),     # 4F
-
-            (self.op_bvc, self.relative, 2),                # 50
-            (self.op_eor, self.zero_page_indirect_y, 5),    # 51
-            (self.op_eor, self.zero_page_indirect, 5),      # 52
-            (self.op_xxx, self.implied, 0),                 # 53
-            (self.op_xxx, self.immediate, 0),               # 54
-            (self.op_eor, self.zero_page_x, 4),             # 55
-            (self.op_lsr, self.zero_page_x, 6),             # 56
-            (self.op_rmb5, self.zero_page, 5),              # 57
-            (self.op_cli, self.implied, 2),                 # 58
-            (self.op_eor, self.absolute_y, 4),              # 59
-            (self.op_phy, self.stack, 3),                   # 5A
-            (self.op_xxx, self.implied, 0),                 # 5B
-            (self.op_xxx, self.absolute, 0),                # 5C
-            (self.op_eor, self.absolute_x, 4),              # 5D
-            (self.op_lsr, self.absolute_x, 7),              # 5E
-            (self.op_bbr5, self.zero_page_relative, 5),     # 5F
-
-            (self.op_rts, self.stack, 6),                   # 60
-            (self.op_adc, self.zero_page_indirect_x, 6),    # 61
-            (self.op_xxx, self.immediate, 0),               # 62
-            (self.op_xxx, self.implied, 0),                 # 63
-            (self.op_stz, self.zero_page, 3),               # 64
-            (self.op_adc, self.zero_page, 3),               # 65
-            (self.op_ror, self.zero_page, 5),               # 66
-            (self.op_rmb6, self.zero_page, 5),              # 67
-            (self.op_pla, self.stack, 4),                   # 68
-            (self.op_adc, self.immediate, 2),               # 69
-            (self.op_ror, self.accumulator, 2),             # 6A
-            (self.op_xxx, self.implied, 0),                 # 6B
-            (self.op_jmp, self.indirect, 6),                # 6C
-            (self.op_adc, self.absolute, 4),                # 6D
-            (self.op_ror, self.absolute, 6),                # 6E
-            (self.op_bbr6, self.zero_page_relative, 5),     # 6F
-
-            (self.op_bvs, self.relative, 2),                # 70
-            (self.op_adc, self.zero_page_indirect_y, 5),    # 71
-            (self.op_adc, self.zero_page_indirect, 5),      # 72
-            (self.op_xxx, self.implied, 0),                 # 73
-            (self.op_stz, self.zero_page_x, 4),             # 74
-            (self.op_adc, self.zero_page_x, 4),             # 75
-            (self.op_ror, self.zero_page_x, 6),             # 76
-            (self.op_rmb7, self.zero_page, 5),              # 77
-            (self.op_sei, self.implied, 2),                 # 78
-            (self.op_adc, self.absolute_y, 4),              # 79
-            (self.op_ply, self.stack, 4),                   # 7A
-            (self.op_xxx, self.implied, 0),                 # 7B
-            (self.op_jmp, self.absolute_indirect_x, 6),     # 7C
-            (self.op_adc, self.absolute_x, 4),              # 7D
-            (self.op_ror, self.absolute_x, 7),              # 7E
-            (self.op_bbr7, self.zero_page_relative, 5),     # 7F
-
-            (self.op_bra, self.relative, 3),                # 80
-            (self.op_sta, self.zero_page_indirect_x, 6),    # 81
-            (self.op_xxx, self.immediate, 0),               # 82
-            (self.op_xxx, self.implied, 0),                 # 83
-            (self.op_sty, self.zero_page, 3),               # 84
-            (self.op_sta, self.zero_page, 3),               # 85
-            (self.op_stx, self.zero_page, 3),               # 86
-            (self.op_smb0, self.zero_page, 5),              # 87
-            (self.op_dey, self.implied, 2),                 # 88
-            (self.op_bit_imm, self.immediate, 2),           # 89
-            (self.op_txa, self.implied, 2),                 # 8A
-            (self.op_xxx, self.implied, 0),                 # 8B
-            (self.op_sty, self.absolute, 4),                # 8C
-            (self.op_sta, self.absolute, 4),                # 8D
-            (self.op_stx, self.absolute, 4),                # 8E
-            (self.op_bbs0, self.zero_page_relative, 5),     # 8F
-
-            (self.op_bcc, self.relative, 2),                # 90
-            (self.op_sta, self.zero_page_indirect_y, 6),    # 91
-            (self.op_sta, self.zero_page_indirect, 5),      # 92
-            (self.op_xxx, self.implied, 0),                 # 93
-            (self.op_sty, self.zero_page_x, 4),             # 94
-            (self.op_sta, self.zero_page_x, 4),             # 95
-            (self.op_stx, self.zero_page_y, 4),             # 96
-            (self.op_smb1, self.zero_page, 5),              # 97
-            (self.op_tya, self.implied, 2),                 # 98
-            (self.op_sta, self.absolute_y, 5),              # 99
-            (self.op_txs, self.implied, 2),                 # 9A
-            (self.op_xxx, self.implied, 0),                 # 9B
-            (self.op_stz, self.absolute, 4),                # 9C
-            (self.op_sta, self.absolute_x, 5),              # 9D
-            (self.op_stz, self.absolute_x, 5),              # 9E
-            (self.op_bbs1, self.zero_page_relative, 5),     # 9F
-
-            (self.op_ldy, self.immediate, 2),               # A0
-            (self.op_lda, self.zero_page_indirect_x, 6),    # A1
-            (self.op_ldx, self.immediate, 2),               # A2
-            (self.op_xxx, self.implied, 0),                 # A3
-            (self.op_ldy, self.zero_page, 3),               # A4
-            (self.op_lda, self.zero_page, 3),               # A5
-            (self.op_ldx, self.zero_page, 3),               # A6
-            (self.op_smb2, self.zero_page, 5),              # A7
-            (self.op_tay, self.implied, 2),                 # A8
-            (self.op_lda, self.immediate, 2),               # A9
-            (self.op_tax, self.implied, 2),                 # AA
-            (self.op_xxx, self.implied, 0),                 # AB
-            (self.op_ldy, self.absolute, 4),                # AC
-            (self.op_lda, self.absolute, 5),                # AD
-            (self.op_ldx, self.absolute, 5),                # AE
-            (self.op_bbs2, self.zero_page_relative, 5),     # AF
-
-            (self.op_bcs, self.relative, 2),                # B0
-            (self.op_lda, self.zero_page_indirect_y, 5),    # B1
-            (self.op_lda, self.zero_page_indirect, 5),      # B2
-            (self.op_xxx, self.implied, 0),                 # B3
-            (self.op_ldy, self.zero_page_x, 4),             # B4
-            (self.op_lda, self.zero_page_x, 4),             # B5
-            (self.op_ldx, self.zero_page_y, 4),             # B6
-            (self.op_smb3, self.zero_page, 5),              # B7
-            (self.op_clv, self.implied, 2),                 # B8
-            (self.op_lda, self.absolute_y, 2),              # B9
-            (self.op_tsx, self.implied, 2),                 # BA
-            (self.op_xxx, self.implied, 0),                 # BB
-            (self.op_ldy, self.absolute_x, 4),              # BC
-            (self.op_lda, self.absolute_x, 4),              # BD
-            (self.op_ldx, self.absolute_y, 4),              # BE
-            (self.op_bbs3, self.zero_page_relative, 5),     # BF
-
-            (self.op_cpy, self.immediate, 2),               # C0
-            (self.op_cmp, self.zero_page_indirect_x, 6),    # C1
-            (self.op_xxx, self.immediate, 0),               # C2
-            (self.op_xxx, self.implied, 0),                 # C3
-            (self.op_cpy, self.zero_page, 3),               # C4
-            (self.op_cmp, self.zero_page, 3),               # C5
-            (self.op_dec, self.zero_page, 5),               # C6
-            (self.op_smb4, self.zero_page, 5),              # C7
-            (self.op_iny, self.implied, 2),                 # C8
-            (self.op_cmp, self.immediate, 2),               # C9
-            (self.op_dex, self.implied, 2),                 # CA
-            (self.op_wai, self.implied, 0),                 # CB
-            (self.op_cpy, self.absolute, 4),                # CC
-            (self.op_cmp, self.absolute, 4),                # CD
-            (self.op_dec, self.absolute, 6),                # CE
-            (self.op_bbs4, self.zero_page_relative, 5),     # CF
-
-            (self.op_bne, self.relative, 2),                # D0
-            (self.op_cmp, self.zero_page_indirect_y, 5),    # D1
-            (self.op_cmp, self.zero_page_indirect, 5),      # D2
-            (self.op_xxx, self.implied, 0),                 # D3
-            (self.op_xxx, self.immediate, 0),               # D4
-            (self.op_cmp, self.zero_page_x, 4),             # D5
-            (self.op_dec, self.zero_page_x, 6),             # D6
-            (self.op_smb5, self.zero_page, 5),              # D7
-            (self.op_cld, self.implied, 2),                 # D8
-            (self.op_cmp, self.absolute_y, 4),              # D9
-            (self.op_phx, self.stack, 3),                   # DA
-            (self.op_stp, self.implied, 0),                 # DB
-            (self.op_xxx, self.absolute, 0),                # DC
-            (self.op_cmp, self.absolute_x, 4),              # DD
-            (self.op_dec, self.absolute_x, 7),              # DE
-            (self.op_bbs5, self.zero_page_relative, 5),     # DF
-
-            (self.op_cpx, self.immediate, 2),               # E0
-            (self.op_sbc, self.zero_page_indirect_x, 6),    # E1
-            (self.op_xxx, self.immediate, 0),               # E2
-            (self.op_xxx, self.implied, 0),                 # E3
-            (self.op_cpx, self.zero_page, 3),               # E4
-            (self.op_sbc, self.zero_page, 3),               # E5
-            (self.op_inc, self.zero_page, 5),               # E6
-            (self.op_smb6, self.zero_page, 5),              # E7
-            (self.op_inx, self.implied, 2),                 # E8
-            (self.op_sbc, self.immediate, 2),               # E9
-            (self.op_nop, self.implied, 2),                 # EA
-            (self.op_xxx, self.implied, 0),                 # EB
-            (self.op_cpx, self.absolute, 4),                # EC
-            (self.op_sbc, self.absolute, 4),                # ED
-            (self.op_inc, self.absolute, 6),                # EE
-            (self.op_bbs6, self.zero_page_relative, 5),     # EF
-
-            (self.op_beq, self.relative, 2),                # F0
-            (self.op_sbc, self.zero_page_indirect_y, 5),    # F1
-            (self.op_sbc, self.zero_page_indirect, 5),      # F2
-            (self.op_xxx, self.implied, 0),                 # F3
-            (self.op_xxx, self.immediate, 0),               # F4
-            (self.op_sbc, self.zero_page_x, 4),             # F5
-            (self.op_inc, self.zero_page_x, 6),             # F6
-            (self.op_smb7, self.zero_page, 5),              # F7
-            (self.op_sed, self.implied, 2),                 # F8
-            (self.op_sbc, self.absolute_y, 4),              # F9
-            (self.op_plx, self.stack, 4),                   # FA
-            (self.op_xxx, self.implied, 0),                 # FB
-            (self.op_xxx, self.absolute, 0),                # FC
-            (self.op_sbc, self.absolute_x, 4),              # FD
-            (self.op_inc, self.absolute_x, 7),              # FE
-            (self.op_bbs7, self.zero_page_relative, 5),     # FF
-        ]
-
     @property
     def zero_page_bug(self):
         return self._zero_page_bug
 
-    def _read_pc(self):
-        out = self.bus[self.PC]
-        self.PC += 1
-        return out
+    @property
+    def P(self):
+        """Status register, with N and Z derived from the last result in lazy flag mode"""
+        if self.lazy_flags:
+            return self._p & ~(FLAG_N | FLAG_Z) | self._n & FLAG_N | (self._z == 0) << 1
+        return self._p
+
+    @P.setter
+    def P(self, value):
+        self._p = value
+        self._n = value
+        self._z = 0 if value & FLAG_Z else 1
 
-    def _read_bytes_pc(self, length):
-        return [self._read_pc() for _ in range(length)]
-    
     def _pop_stack(self):
         self.S = (self.S + 1) & 0xFF
-        out = 0x0100 + self.S
-        return self.bus[out]
+        return self._read_pages[1][self.S]
 
     def _push_stack(self, val):
-        address = 0x0100 + self.S
+        self._write_pages[1][self.S] = val
         self.S = (self.S - 1) & 0xFF
-        self.bus[address] = val
+
+    @staticmethod
+    def address_lengths(mode):
+        return _MODES[mode][0]
+
+    @staticmethod
+    def _twos_complement(val):
+        if val & 0x80:
+            return val - (1 << 8)
+        else:
+            return val
+
+    def address_text(self, mode, text, pc):
+        if mode == 'relative':
+            text[0] = pc + self.address_lengths(mode) + 1 + self._twos_complement(text[0])
+        elif mode == 'zero_page_relative':
+            text[1] = pc + self.address_lengths(mode) + 1 + self._twos_complement(text[1])
+        return _MODES[mode][2].format(*text)
 
     def reset(self):
+        self._idle_state = None
         reset_location = 0xFFFC
         self.PC = self.bus[reset_location] | self.bus[reset_location+1] << 8
-        self.P = Status['UBI']
+        self.P = FLAG_U | FLAG_B | FLAG_I
         self.A = 0x00  # Accumulator
         self.X = 0x00  # X register
         self.Y = 0x00  # Y register
         self.S = 0xFD  # Stack pointer
+        self.waiting = False
         self.cycles = 8
+        self.total_cycles += 8
 
     def irq(self):
-        if not self.P & Status['I']:
-            self.P &= ~Status['B']
+        self._idle_state = None
+        self.waiting = False
+        if not self._p & FLAG_I:
+            self.P &= ~FLAG_B
             self._push_stack((self.PC & 0xFF00) >> 8)  # PC high byte
             self._push_stack(self.PC & 0xFF)  # PC Low byte
             self._push_stack(self.P)
@@ -1315,9 +980,12 @@ class Cpu6502(Address6502, Ops6502):
             irq_location = 0xFFFE
             self.PC = self.bus[irq_location] | self.bus[irq_location + 1] << 8
             self.cycles = 7
+            self.total_cycles += 7
 
     def nmi(self):
-        self.P &= ~ Status['B']
+        self._idle_state = None
+        self.waiting = False
+        self.P &= ~FLAG_B
         self._push_stack((self.PC & 0xFF00) >> 8)  # PC high byte
         self._push_stack(self.PC & 0xFF)  # PC Low byte
         self._push_stack(self.P)  # Status register
@@ -1325,20 +993,188 @@ class Cpu6502(Address6502, Ops6502):
         nmi_location = 0xFFFA
         self.PC = self.bus[nmi_location] | self.bus[nmi_location + 1] << 8
         self.cycles = 8
+        self.total_cycles += 8
 
     def clock(self):
+        self.deadline = 0   # No idle loop skipping outside run()
+        if self.waiting:
+            self.total_cycles += 1
+            if self.total_cycles >= self.bus.next_event:
+                self.bus.run_events()
+                self._idle_state = None   # Events may change what an idle loop polls
+            return False
         if self.cycles == 0:
-            op_code = self.bus[self.PC]
-            self.PC += 1
-            operation, address_mode, cycles = self.matrix[op_code]
-            self.cycles = cycles
-            operation(address_mode)
+            pc = self.PC
+            for hook in self.hooks:
+                hook(self, pc)
+            op_code = self._read_pages[pc >> 8][pc & 0xFF]
+            self.PC = pc + 1
+            self.cycles = self.handlers[op_code](self)
+            self.total_cycles += self.cycles
+            if self.total_cycles >= self.bus.next_event:
+                self.bus.run_events()
+                self._idle_state = None
             return True
         self.cycles -= 1
         return False
 
-    def list_commands(self, number=-1):
-        temp_pc = self.PC
+    def run(self, max_cycles):
+        """Executes whole instructions until at least max_cycles have elapsed, returning the cycles used.
+        Instructions run uninterrupted up to the next bus event, whose callbacks are called in between.
+        While waiting after WAI, or in an idle loop with skip_idle set, time jumps ahead to the next event.
+        With compiled blocks enabled the run may overshoot by the rest of the last block"""
+        handlers = self.handlers
+        read_pages = self._read_pages
+        bus = self.bus
+        start = self.total_cycles
+        end = start + max_cycles
+        self.cycles = 0
+        self._idle_state = None     # Memory may have changed since the last run
+        while True:
+            self.deadline = min(end, bus.next_event)
+            if self.waiting:
+                self.total_cycles = max(self.total_cycles, self.deadline)
+            elif self.hooks:
+                self._run_hooked()
+            elif self.block_cache is not None:
+                self._run_blocks()
+            while self.total_cycles < self.deadline:
+                pc = self.PC
+                self.PC = pc + 1
+                self.total_cycles += handlers[read_pages[pc >> 8][pc & 0xFF]](self)
+            if self.total_cycles >= bus.next_event:
+                bus.run_events()
+                self._idle_state = None
+            if self.total_cycles >= end:
+                return self.total_cycles - start
+
+    def _run_hooked(self):
+        handlers = self.handlers
+        read_pages = self._read_pages
+        while self.total_cycles < self.deadline:
+            pc = self.PC
+            for hook in self.hooks:
+                hook(self, pc)
+            self.PC = pc + 1
+            self.total_cycles += handlers[read_pages[pc >> 8][pc & 0xFF]](self)
+
+    def _run_blocks(self):
+        handlers = self.handlers
+        read_pages = self._read_pages
+        cache = self.block_cache
+        blocks = cache.blocks
+        while self.total_cycles < self.deadline:
+            pc = self.PC
+            block = blocks.get(pc) or cache.miss(pc)
+            if block is None:
+                self.PC = pc + 1
+                self.total_cycles += handlers[read_pages[pc >> 8][pc & 0xFF]](self)
+            else:
+                self.total_cycles += block(self)
+
+    def run_until(self, predicate=None, pc=None, cycle_count=None):
+        """Executes whole instructions until predicate(cpu) is true, PC reaches pc or total_cycles reaches
+        cycle_count, whichever happens first. At least one instruction is run unless waiting after WAI with no
+        event or cycle_count to wake up for. Returns the cycles used.
+        Compiled blocks and idle loop skipping are not used, so every instruction boundary is checked"""
+        self.deadline = 0   # Left at 0 so idle loops never find cycles to skip
+        handlers = self.handlers
+        read_pages = self._read_pages
+        bus = self.bus
+        start = self.total_cycles
+        stop_pc = -1 if pc is None else pc
+        end = float('inf') if cycle_count is None else cycle_count
+        self.cycles = 0
+        while True:
+            if self.waiting:
+                wake = min(end, bus.next_event)
+                if wake == float('inf'):
+                    return self.total_cycles - start
+                self.total_cycles = max(self.total_cycles, wake)
+                if self.total_cycles >= bus.next_event:
+                    bus.run_events()
+                    self._idle_state = None
+                if self.total_cycles >= end:
+                    return self.total_cycles - start
+                continue
+            address = self.PC
+            if self.hooks:
+                for hook in self.hooks:
+                    hook(self, address)
+            self.PC = address + 1
+            self.total_cycles += handlers[read_pages[address >> 8][address & 0xFF]](self)
+            if self.total_cycles >= bus.next_event:
+                bus.run_events()
+                self._idle_state = None
+            if self.PC == stop_pc or self.total_cycles >= end or (predicate is not None and predicate(self)):
+                return self.total_cycles - start
+
+    def snapshot(self, previous=None):
+        """Registers, cycle counters and device memory. Memory pages that did not change since previous, an
+        earlier snapshot of this machine, are shared with it, so frequent snapshots are cheap. They are
+        cheapest when previous is the snapshot last taken or restored, as dirty tracking RAM then only
+        compares the pages written since. Events scheduled on the bus are not included"""
+        registers = (self.A, self.X, self.Y, self.S, self.P, self.PC, self.total_cycles, self.cycles, self.waiting)
+        return Snapshot(registers, self.bus.snapshot(previous and previous.devices))
+
+    def restore(self, snapshot):
+        """Returns the machine to a snapshot. A snapshot can be restored any number of times"""
+        self.A, self.X, self.Y, self.S, self.P, self.PC, self.total_cycles, self.cycles, self.waiting = \
+            snapshot.registers
+        self.bus.restore(snapshot.devices)
+        self._idle_state = None
+        self.deadline = self.total_cycles   # A deadline from before would be measured on the old clock
+
+    def add_hook(self, hook):
+        """Calls hook(cpu, pc) before every instruction, with total_cycles as it was before it. While any
+        hook is installed run() goes through a slower loop that skips compiled blocks"""
+        if hook not in self.hooks:
+            self.hooks += (hook,)
+
+    def remove_hook(self, hook):
+        self.hooks = tuple(other for other in self.hooks if other != hook)
+
+    def _idle_loop(self, end):
+        """Called by backward jumps when skip_idle is set. If the loop from PC up to end came back to the
+        same registers without writing anything, every further pass will do the same until an event or
+        interrupt changes something, so whole passes are skipped up to the run() deadline.
+        Returns the cycles skipped. Polled devices are assumed to change only from bus events"""
+        start = self.PC
+        if end - start > _IDLE_LENGTH:
+            return 0
+        state = (start, self.A, self.X, self.Y, self.P, self.S)
+        previous = self._idle_state
+        self._idle_state = (state, self.total_cycles)
+        if previous is None or previous[0] != state:
+            return 0
+        period = self.total_cycles - previous[1]
+        passes = (self.deadline - self.total_cycles) // period - 1 if period > 0 else 0
+        if passes <= 0 or not self._idle_body(start, end):
+            return 0
+        self._idle_state = (state, self.total_cycles + passes * period)
+        return passes * period
+
+    def _idle_body(self, start, end):
+        """True if the code from start to end only changes registers and flags"""
+        address = start
+        try:
+            while address < end:
+                operation, mode, _ = self.matrix[self.bus[address]]
+                if operation not in _IDLE_SAFE:
+                    return False
+                address += 1 + _MODES[mode][0]
+        except IndexError:
+            return False
+        return address == end
+
+    def disassemble(self, address):
+        """Text and length in bytes of the instruction at address. Raises IndexError past mapped memory"""
+        return self.disassembly.get(address)
+
+    def list_commands(self, number=-1, start=None):
+        """Disassembles number instructions from start or the PC, stopping before an instruction that is not
+        entirely within mapped memory or runs past the end of the address space"""
+        temp_pc = self.PC if start is None else start
         out = OrderedDict()
         if number < 0:
             iterator = itertools.count()
@@ -1346,20 +1182,11 @@ class Cpu6502(Address6502, Ops6502):
             iterator = range(number)
 
         for _ in iterator:
-            init_pc = temp_pc
-            try:
-                op_code = self.bus[temp_pc]
-                temp_pc += 1
-                operation, address_mode, _ = self.matrix[op_code]
-                n_address = self.address_lengths(address_mode)
-                address_values = []
-                for _ in range(n_address):
-                    address_values.append(self.bus[temp_pc])
-                    temp_pc += 1
-                address_text = self.address_text(address_mode, address_values, init_pc)
-            except IndexError:
+            if temp_pc > 0xFFFF or not self.bus.mapped(temp_pc):
                 break
-
-            name = operation.__name__.split('_')[1].upper()
-            out[init_pc] = f'{init_pc:04X}:    {name} {address_text}'
+            end = temp_pc + _MODES[self.matrix[self.bus[temp_pc]][1]][0]
+            if end > 0xFFFF or not self.bus.mapped(end):
+                break
+            out[temp_pc], length = self.disassemble(temp_pc)
+            temp_pc += length
         return out
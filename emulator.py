@@ -2,90 +2,94 @@
 # -*- coding: utf-8 -*-
 """The main emulation code"""
 
+import bisect
 import gi
-from array import array
+import threading
+import time
 gi.require_version('Gtk', '3.0')
 from gi.repository import Gtk, GLib, GdkPixbuf
 
+import cpu6502
+from history import History
+from video import Color, CpuState, VideoBuffer, union
 
-class Color:
-    """Holds color information"""
 
-    def __init__(self, red=255, green=255, blue=255):
-        self.red = red
-        self.green = green
-        self.blue = blue
+class EmulationThread(threading.Thread):
+    """Runs the cpu at a target clock rate outside the GTK main loop. After every frame's worth of cycles
+    the video buffer is copied into the back of two frame buffers, which is then swapped to the front and
+    handed with a register snapshot to present(frame, dirty, state) on the main loop"""
 
-    def __str__(self):
-        return f'{self.red:02X}{self.green:02X}{self.blue:02X}'
-
-    def __int__(self):
-        return (self.red << 16) + (self.green << 8) + self.blue
-
-    def __iter__(self):
-        return (x for x in [self.red, self.green, self.blue])
-
-    def invert(self):
-        self.red = self.red ^ 0xFF
-        self.green = self.green ^ 0xFF
-        self.blue = self.blue ^ 0xFF
-
-
-class VideoBuffer:
-    """Video Buffer Class"""
-    def __init__(self, width=256, height=240, scale=1):
-        self.width = width
-        self.height = height
-        self.scale = scale
-        self.header = array('B', bytes(f'P6 {self.overall_width:d} {self.overall_height:d} 255 ', 'utf-8'))
-        self.data = array('B', [0 for _ in range(3 * self.overall_size)])
-
-    def output(self):
-        return self.header + self.data
-
-    def fill(self, color):
-        self.data = array('B', self.overall_width * self.overall_height * list(color))
-
-    def __getitem__(self, pos):
-        x, y = pos
-        assert(x < self.width)
-        assert(y < self.height)
-        index = self.scale * 3 * (y * self.overall_width + x)
-        return Color(self.data[index], self.data[index+1], self.data[index+2])
-
-    def __setitem__(self, pos, color):
-        x, y = pos
-        assert(x < self.width)
-        assert(y < self.height)
-        index = self.scale * 3 * (y * self.overall_width + x)
-        for local_y in range(self.scale):
-            for local_x in range(self.scale):
-                for n, val in enumerate(color):
-                    self.data[index + 3 * (local_y * self.overall_width + local_x) + n] = val
-
-    @property
-    def overall_width(self):
-        return self.width * self.scale
-
-    @property
-    def overall_height(self):
-        return self.height * self.scale
-
-    @property
-    def overall_size(self):
-        return self.overall_width * self.overall_height
+    def __init__(self, cpu, video_buffer, present, clock_rate=1000000, frame_rate=60, lock=None):
+        super().__init__(daemon=True)
+        self.cpu = cpu
+        self.video_buffer = video_buffer
+        self.present = present
+        self.cycles_per_frame = clock_rate // frame_rate
+        self.frame_time = 1 / frame_rate
+        # Held while the cpu runs, take it to use the cpu from another thread. present() is called holding it
+        self.lock = lock or threading.RLock()
+        self._handoff = threading.Lock()
+        self._frames = [bytearray(len(video_buffer.data)), bytearray(len(video_buffer.data))]
+        self._dirty = None  # Damage not yet presented
+        self._state = None
+        self._pending = False
+        self._stopped = threading.Event()
+
+    def run(self):
+        next_frame = time.perf_counter()
+        while not self._stopped.is_set():
+            with self.lock:
+                self.cpu.run(self.cycles_per_frame)
+                self._publish()
+            next_frame += self.frame_time
+            delay = next_frame - time.perf_counter()
+            if delay > 0:
+                self._stopped.wait(delay)
+            else:
+                next_frame = time.perf_counter()    # Running behind, drop the time rather than catch up
+
+    def stop(self):
+        self._stopped.set()
+        self.join()
+
+    def _publish(self):
+        cpu = self.cpu
+        dirty = self.video_buffer.take_dirty()
+        if dirty is not None:
+            self._frames[1][:] = self.video_buffer.data
+        with self._handoff:
+            if dirty is not None:
+                self._frames.reverse()
+                self._dirty = union(self._dirty, dirty)
+            self._state = CpuState(cpu.PC, cpu.A, cpu.X, cpu.Y, cpu.S, cpu.P, cpu.total_cycles)
+            if not self._pending:
+                self._pending = True
+                GLib.idle_add(self._deliver)
+
+    def _deliver(self):
+        # present() may disassemble, which reads the bus and changes its watches, so the cpu has to be stopped.
+        # The lock is taken before the handoff, in the same order as run() and _publish()
+        with self.lock, self._handoff:
+            self._pending = False
+            dirty, self._dirty = self._dirty, None
+            self.present(self._frames[0], dirty, self._state)
+        return False
 
 
 # noinspection PyArgumentList,PyUnresolvedReferences
 class ProgramList:
+    """Disassembly listing that decodes a window of instructions at a time, from PC and wherever PC goes
+    next, keeping the rows in address order"""
+    window = 64     # Instructions decoded at a time
+    margin = 16     # Rows kept decoded below the current one
 
-    def __init__(self, cpu):
+    def __init__(self, cpu, lock=None):
         self.cpu = cpu
+        self.lock = lock or threading.RLock()   # Held while disassembling, shared with a thread running the cpu
         self.model = Gtk.ListStore(str, int)
-        self.index = list()
-        for index, text in self.cpu.list_commands().items():
-            self.index.append(index)
-            self.model.append((text, 0))
+        self.rows = dict()          # Address: Gtk.TreeIter of its row, which stays valid as rows are inserted
+        self.addresses = list()     # Listed addresses, sorted
+        self.end = None             # Address after the last row, None past mapped memory
         self.renderer = Gtk.CellRendererText()
         self.column = Gtk.TreeViewColumn('Commands', self.renderer, text=0, weight_set=True)
         self.column.set_cell_data_func(self.renderer, self.current)
@@ -94,15 +98,42 @@ class ProgramList:
         self.view = Gtk.ScrolledWindow()
         self.view.set_vexpand(True)
         self.view.add(self.tree)
-        self.current_index = 0
+        self.view.get_vadjustment().connect('value-changed', self.scrolled)
+        self.current_address = None
+        self.reset_data()
 
     def reset_data(self):
         self.model.clear()
-        self.index = list()
-        for index, text in self.cpu.list_commands().items():
-            self.index.append(index)
-            self.model.append((text, 0))
-        self.current_index = 0
+        self.rows = dict()
+        self.addresses = list()
+        self.end = None
+        self.current_address = None
+        self.extend(self.cpu.PC)
+
+    def extend(self, address):
+        """Lists up to a window of instructions from address, stopping where the listing already has one"""
+        for _ in range(self.window):
+            if address is None or address in self.rows:
+                return
+            try:
+                text, length = self.cpu.disassemble(address)
+            except IndexError:
+                if not self.addresses or address > self.addresses[-1]:
+                    self.end = None
+                return
+            position = bisect.bisect(self.addresses, address)
+            self.addresses.insert(position, address)
+            if position + 1 < len(self.addresses):
+                self.rows[address] = self.model.insert_before(self.rows[self.addresses[position + 1]], (text, 0))
+            else:
+                self.rows[address] = self.model.append((text, 0))
+                self.end = address + length
+            address += length
+
+    def scrolled(self, adjustment):
+        if adjustment.get_value() + 2 * adjustment.get_page_size() >= adjustment.get_upper():
+            with self.lock:
+                self.extend(self.end)
 
     @staticmethod
     def current(_, renderer, model, titer, __):
@@ -111,25 +142,34 @@ class ProgramList:
             renderer.set_property("weight", 700)
 
     def set_index(self, address):
-        try:
-            new_index = self.index.index(address)
-            if new_index == self.current_index:
+        row = self.rows.get(address)
+        if row is None:
+            self.extend(address)
+            row = self.rows.get(address)
+            if row is None:
                 return None
-        except ValueError:
-            self.reset_data()
-            new_index = self.current_index
+        elif address == self.current_address:
+            return None
 
-        self.model[self.current_index][1] = 0
-        self.current_index = new_index
-        self.model[self.current_index][1] = 1
-        self.tree.set_cursor(self.current_index)
-        return self.model[self.current_index][0]
+        if len(self.addresses) < self.margin or address >= self.addresses[-self.margin]:
+            self.extend(self.end)
+        if self.current_address is not None:
+            self.model.set_value(self.rows[self.current_address], 1, 0)
+        self.current_address = address
+        self.model.set_value(row, 1, 1)
+        self.tree.set_cursor(self.model.get_path(row))
+        return self.model.get_value(row, 0)
 
 
 # noinspection PyArgumentList,PyUnresolvedReferences
 class HistoryList:
+    """Shows the last rows of a History, formatted only when refreshed while on screen"""
 
-    def __init__(self):
+    def __init__(self, history, cpu, rows=100):
+        self.history = history
+        self.cpu = cpu
+        self.rows = rows
+        self.shown = None   # history.count when the model was last filled
         self.model = Gtk.ListStore(str, str, str, str, str, str)
         self.renderer = Gtk.CellRendererText()
         self.column = Gtk.TreeViewColumn('History', self.renderer, text=0)
@@ -146,18 +186,19 @@ class HistoryList:
         self.view.set_vexpand(True)
         self.view.add(self.tree)
 
-    def add_row(self, data, a, x, y, s, p):
-        if data:
-            self.model.append((data,
+    def refresh(self):
+        if not self.view.get_mapped() or self.history.count == self.shown:
+            return
+        self.shown = self.history.count
+        self.model.clear()
+        for pc, a, x, y, s, p, _ in self.history.latest(self.rows):
+            self.model.append((self.cpu.disassemble(pc)[0],
                                f'{a:02X} [{a:d}]',
                                f'{x:02X} [{x:d}]',
                                f'{y:02X} [{y:d}]',
                                f'{s:02X}',
                                f'{p:08b}'
                                ))
-            # noinspection PyTypeChecker
-            if len(self.model) > 100:
-                del(self.model[0])
 
 
 # noinspection PyArgumentList,PyUnresolvedReferences
@@ -202,32 +243,42 @@ class Registers(Gtk.Frame):
         self.grid.attach_next_to(self.P, self.P_label, Gtk.PositionType.RIGHT, 1, 1)
         self.update()
 
-    def get_status(self):
+    def get_status(self, p):
         out = ''
         for flag in self.status.flags():
-            if self.cpu.P & self.status[flag]:
+            if p & self.status[flag]:
                 settings = 'foreground="green" weight="bold"'
             else:
                 settings = 'foreground="red"'
             out += f'<span {settings}>{flag}</span> '
         return out
 
-    def update(self):
-        self.PC.set_markup(f'${self.cpu.PC:04X}')
-        self.A.set_markup(f'${self.cpu.A:02X} [{self.cpu.A:d}]')
-        self.X.set_markup(f'${self.cpu.X:02X} [{self.cpu.X:d}]')
-        self.Y.set_markup(f'${self.cpu.Y:02X} [{self.cpu.Y:d}]')
-        self.S.set_markup(f'$(01){self.cpu.S:02X}')
-        self.P.set_markup(self.get_status())
+    def update(self, cpu=None):
+        """Shows the registers of the cpu, or of a CpuState taken from it"""
+        cpu = cpu or self.cpu
+        self.PC.set_markup(f'${cpu.PC:04X}')
+        self.A.set_markup(f'${cpu.A:02X} [{cpu.A:d}]')
+        self.X.set_markup(f'${cpu.X:02X} [{cpu.X:d}]')
+        self.Y.set_markup(f'${cpu.Y:02X} [{cpu.Y:d}]')
+        self.S.set_markup(f'$(01){cpu.S:02X}')
+        self.P.set_markup(self.get_status(cpu.P))
 
 
 # noinspection PyArgumentList,PyUnresolvedReferences
 class Screen(Gtk.Window):
-    """Class to produce window"""
-    def __init__(self, cpu, width=256, height=240, scale=1, title=None, background=Color(0xAD, 0xD8, 0xE6)):
+    """Class to produce window. With a clock_rate, Start runs the cpu at that rate in an EmulationThread
+    and the window is redrawn at 60 Hz; otherwise it executes one instruction every 5 ms.
+    A history_depth above 0 records that many executed instructions for a history pane. The History is a cpu
+    hook, and while any hook is installed run() steps one instruction at a time, so compiled blocks and idle
+    loop skipping are not used"""
+    def __init__(self, cpu, width=256, height=240, scale=1, title=None, background=Color(0xAD, 0xD8, 0xE6),
+                 clock_rate=None, history_depth=0):
         Gtk.Window.__init__(self)
         self.cpu = cpu
         self.timer = 0
+        self.clock_rate = clock_rate
+        self.thread = None
+        self.lock = threading.RLock()   # Guards the cpu against the EmulationThread, reentrant for GTK signals
         self.connect("destroy", Gtk.main_quit)
         if title:
             self.set_title(title)
@@ -240,6 +291,8 @@ class Screen(Gtk.Window):
         self.add(self.grid)
         self.video_buffer = VideoBuffer(self.width, self.height, self.scale)
         self.video_buffer.fill(background)
+        self.pixel_buffer = GdkPixbuf.Pixbuf.new(GdkPixbuf.Colorspace.RGB, False, 8,
+                                                 self.video_buffer.overall_width, self.video_buffer.overall_height)
         self.image = Gtk.Image()
         self.grid.attach(self.image, 0, 0, 6, 6)
         self.reset_btn = Gtk.Button(label="Reset")
@@ -258,54 +311,91 @@ class Screen(Gtk.Window):
         self.grid.attach_next_to(self.start_btn, self.nmi_btn, Gtk.PositionType.RIGHT, 2, 1)
         self.grid.attach_next_to(self.command_btn, self.start_btn, Gtk.PositionType.RIGHT, 2, 1)
         self.registers = Registers(self.cpu)
-        self.program_list = ProgramList(self.cpu)
+        self.program_list = ProgramList(self.cpu, self.lock)
         self.grid.attach_next_to(self.registers, self.image, Gtk.PositionType.RIGHT, 3, 1)
         self.grid.attach_next_to(self.program_list.view, self.registers, Gtk.PositionType.BOTTOM, 3, 5)
-        self.history_list = HistoryList()
-        self.grid.attach_next_to(self.history_list.view, self.registers, Gtk.PositionType.RIGHT, 6, 6)
+        self.history = self.history_list = None
+        if history_depth > 0:
+            self.history = History(history_depth)
+            self.cpu.add_hook(self.history)
+            self.history_list = HistoryList(self.history, self.cpu)
+            self.grid.attach_next_to(self.history_list.view, self.registers, Gtk.PositionType.RIGHT, 6, 6)
         self.draw()
         self.show_all()
 
     def reset(self, _):
-        self.cpu.reset()
-        self.draw()
+        self.interrupt(self.cpu.reset)
 
     def irq(self, _):
-        self.cpu.irq()
-        self.draw()
+        self.interrupt(self.cpu.irq)
 
     def nmi(self, _):
-        self.cpu.irq()
-        self.draw()
+        self.interrupt(self.cpu.irq)
+
+    def interrupt(self, signal):
+        if self.thread:
+            with self.thread.lock:
+                signal()
+        else:
+            signal()
+            self.draw()
 
     def command(self, _=None):
-        while not self.cpu.clock():
-            pass
+        self.cpu.run(1)
         self.draw()
         return True
 
     def start(self, _):
         if self.start_btn.get_label() == 'Start':
             self.start_btn.set_label('Stop')
-            self.timer = GLib.timeout_add(5, self.command)
+            if self.clock_rate:
+                self.command_btn.set_sensitive(False)
+                self.thread = EmulationThread(self.cpu, self.video_buffer, self.present, self.clock_rate,
+                                              lock=self.lock)
+                self.thread.start()
+            else:
+                self.timer = GLib.timeout_add(5, self.command)
         else:
             self.start_btn.set_label('Start')
-            GLib.source_remove(self.timer)
-            self.timer = 0
+            if self.thread:
+                self.thread.stop()
+                self.thread = None
+                self.command_btn.set_sensitive(True)
+                self.draw()
+            else:
+                GLib.source_remove(self.timer)
+                self.timer = 0
+
+    def present(self, frame, dirty, state):
+        """Shows a frame and register snapshot handed over by the EmulationThread"""
+        self.draw_video(frame, dirty)
+        self.draw_state(state)
+
+    def draw_video(self, data, dirty):
+        """Copies the changed part of a frame into the displayed pixbuf, if anything changed"""
+        if dirty is None:
+            return
+        video = self.video_buffer
+        x, y, width, height = dirty
+        start = y * video.rowstride + 3 * x
+        end = (y + height - 1) * video.rowstride + 3 * (x + width)
+        damaged = GdkPixbuf.Pixbuf.new_from_bytes(GLib.Bytes.new(data[start:end]), GdkPixbuf.Colorspace.RGB,
+                                                  False, 8, width, height, video.rowstride)
+        damaged.copy_area(0, 0, width, height, self.pixel_buffer, x, y)
+        self.image.set_from_pixbuf(self.pixel_buffer)
+
+    def draw_state(self, cpu):
+        self.program_list.set_index(cpu.PC)
+        if self.history_list:
+            self.history_list.refresh()
+        self.registers.update(cpu)
 
     def draw(self):
-        loader = GdkPixbuf.PixbufLoader.new_with_type('pnm')
-        loader.write(self.video_buffer.output())
-        pixel_buffer = loader.get_pixbuf()
-        loader.close()
-        self.image.set_from_pixbuf(pixel_buffer)
-        text = self.program_list.set_index(self.cpu.PC)
-        self.history_list.add_row(text, self.cpu.A, self.cpu.X, self.cpu.Y, self.cpu.S, self.cpu.P)
-        self.registers.update()
+        self.draw_video(self.video_buffer.data, self.video_buffer.take_dirty())
+        self.draw_state(self.cpu)
 
 
 if __name__ == "__main__":
-    import cpu6502
     import memory
     import bus
 
@@ -313,5 +403,5 @@ if __name__ == "__main__":
     m = memory.RAM(b, 65536)
     b.register(m, 0)
     c = cpu6502.Cpu6502(b, False)
-    win = Screen(c, scale=2, title="Emulator")
+    win = Screen(c, scale=2, title="Emulator", history_depth=100000)
     Gtk.main()
@@ -0,0 +1,59 @@
+#! /usr/bin/env python
+# -*- coding: utf-8 -*-
+"""Execution history kept in preallocated arrays"""
+
+from array import array
+
+
+class History:
+    """Ring buffer of the registers before each executed instruction. Install it with cpu.add_hook(history).
+    Records are (PC, A, X, Y, S, P, cycles) tuples, oldest first"""
+
+    def __init__(self, depth=100):
+        self.depth = depth
+        self.pc = array('H', bytes(2 * depth))
+        self.a = bytearray(depth)
+        self.x = bytearray(depth)
+        self.y = bytearray(depth)
+        self.s = bytearray(depth)
+        self.p = bytearray(depth)
+        self.cycles = array('Q', bytes(8 * depth))
+        self.count = 0      # Records written since creation, including the overwritten ones
+        self._next = 0      # Slot the next record goes into
+
+    def __call__(self, cpu, pc):
+        index = self._next
+        self.pc[index] = pc
+        self.a[index] = cpu.A
+        self.x[index] = cpu.X
+        self.y[index] = cpu.Y
+        self.s[index] = cpu.S
+        self.p[index] = cpu.P
+        self.cycles[index] = cpu.total_cycles
+        self._next = 0 if index + 1 == self.depth else index + 1
+        self.count += 1
+
+    def __len__(self):
+        return min(self.count, self.depth)
+
+    def __getitem__(self, item):
+        length = len(self)
+        if item < 0:
+            item += length
+        if not 0 <= item < length:
+            raise IndexError(item)
+        index = (self._next - length + item) % self.depth
+        return (self.pc[index], self.a[index], self.x[index], self.y[index], self.s[index], self.p[index],
+                self.cycles[index])
+
+    def __iter__(self):
+        return (self[item] for item in range(len(self)))
+
+    def latest(self, number):
+        """The last number records, oldest first"""
+        length = len(self)
+        return [self[item] for item in range(max(length - number, 0), length)]
+
+    def clear(self):
+        self.count = 0
+        self._next = 0
@@ -3,22 +3,29 @@
 """Memory devices are stored here"""
 
 import array
+import mmap
+import os
 
-from bus import BusDevice
+from bus import BusDevice, DIRTY_ALL, PAGE_SIZE
+
+DIRTY_SNAPSHOT = 0x80   # Consumer bit used by snapshot()
 
 
 class RAM(BusDevice):
-    """Emulates an 8bit ram"""
+    """Emulates an 8bit ram. With track_dirty, every write marks its 256 byte page in a bitmap. Each byte of
+    the bitmap holds one bit per consumer, so several consumers can each collect the pages written since
+    they last looked, see consume_dirty()"""
 
-    def __init__(self, bus, size, start_location=0, data=None):
+    def __init__(self, bus, size, start_location=0, data=None, track_dirty=False):
         super().__init__(bus)
-        self._data = array.array('B', (0 for _ in range(size)))
+        self.dirty = bytearray([DIRTY_ALL]) * -(-size // PAGE_SIZE) if track_dirty else None
+        self._snapshot = None   # State last returned by snapshot() or passed to restore()
+        self._data = array.array('B', bytes(size))
         if data:
-            for idx, val in enumerate(data):
-                address = start_location + idx
-                if address > size:
-                    raise OverflowError(f'{address:04X} is outside of allowed range')
-                self._data[address] = val
+            end = start_location + len(data)
+            if end > size:
+                raise OverflowError(f'{end - 1:04X} is outside of allowed range')
+            memoryview(self._data)[start_location:end] = bytes(data)
 
     def __getitem__(self, address):
         return self._data[address]
@@ -27,6 +34,8 @@ class RAM(BusDevice):
         if (address < 0) or (address > self.size):
             raise IndexError
         self._data[address] = data
+        if self.dirty is not None:
+            self.dirty[address // PAGE_SIZE] = DIRTY_ALL
 
     def __iter__(self):
         return iter(self._data)
@@ -42,6 +51,62 @@ class RAM(BusDevice):
     def absolute_address(self):
         return False
 
+    @property
+    def read_buffer(self):
+        return self._data
+
+    @property
+    def write_buffer(self):
+        return self._data
+
+    @property
+    def dirty_pages(self):
+        return self.dirty
+
+    def consume_dirty(self, consumer=0x01):
+        """Numbers of the pages written since the last call with the same consumer bit, which is then cleared.
+        Bits 0x01 to 0x40 are free for callers. Raises ValueError without dirty tracking"""
+        if self.dirty is None:
+            raise ValueError(f'{self} was created without track_dirty')
+        pages = [number for number, bits in enumerate(self.dirty) if bits & consumer]
+        for number in pages:
+            self.dirty[number] &= ~consumer
+        return pages
+
+    def snapshot(self, previous=None):
+        """Contents as a tuple of immutable 256 byte pages, reusing the pages of previous that did not change.
+        previous may be any earlier snapshot of this RAM. With dirty tracking, only the pages written since are
+        compared when it is the state last taken or restored, and every page otherwise"""
+        self._snapshot = self._pages(previous, previous is not None and previous is self._snapshot)
+        return self._snapshot
+
+    def _pages(self, previous, current):
+        view = memoryview(self._data)
+        if previous is None:
+            pages = [None] * -(-len(view) // PAGE_SIZE)
+        else:
+            pages = list(previous)
+        numbers = range(len(pages))
+        if self.dirty is not None:
+            written = self.consume_dirty(DIRTY_SNAPSHOT)
+            if current:
+                numbers = written
+        for number in numbers:
+            page = view[number * PAGE_SIZE:(number + 1) * PAGE_SIZE]
+            if pages[number] is None or pages[number] != page:
+                pages[number] = page.tobytes()
+        return tuple(pages)
+
+    def restore(self, state):
+        self._snapshot = state
+        view = memoryview(self._data)
+        for number, page in enumerate(state):
+            start = number * PAGE_SIZE
+            if view[start:start + len(page)] != page:
+                view[start:start + len(page)] = page
+                if self.dirty is not None:
+                    self.dirty[number] = DIRTY_ALL
+
     def print_contents(self, offset=0):
         """Lists the contents of the RAM"""
         for idx, val in enumerate(self):
@@ -53,13 +118,17 @@ class RAM(BusDevice):
             print(f'{idx:0X}: {val:0X}', end=end)
 
     def load_from_file(self, file, start_index=0):
-        """Load the ram from a binary file"""
+        """Load the ram from a binary file. Watchers of the bus pages showing it are told they were remapped"""
         with open(file, 'rb') as fid:
-            data = fid.read()
-        index = start_index
-        for byte in data:
-            self._data[index] = byte  # Cannot use __setitem__ to let ROM load from file
-            index += 1
+            index = start_index + os.fstat(fid.fileno()).st_size
+            if index > self.size:
+                raise IndexError(f'{index - 1:04X} is outside of the memory')
+            # Read straight into the array. Cannot use __setitem__ to let ROM load from file
+            fid.readinto(memoryview(self._data)[start_index:index])
+        if self.dirty is not None:
+            for number in range(start_index // PAGE_SIZE, -(-index // PAGE_SIZE)):
+                self.dirty[number] = DIRTY_ALL
+        self.bus.invalidate(self, start_index, index)
 
 
 class ROM(RAM):
@@ -67,3 +136,99 @@ class ROM(RAM):
 
     def __setitem__(self, address, data):
         raise TypeError(f"'{self.__class__}' object does not support item assignment")
+
+    @property
+    def write_buffer(self):
+        return None
+
+    def snapshot(self, previous=None):
+        return None
+
+    def restore(self, state):
+        pass
+
+
+class MappedROM(ROM):
+    """ROM holding a memory-mapped image file, read-only and without copying it. Unlike RAM and ROM it is
+    addressed from 0 at the address it is registered at"""
+
+    def __init__(self, bus, file, offset=0, size=0):
+        BusDevice.__init__(self, bus)
+        self.dirty = None
+        with open(file, 'rb') as fid:
+            self._data = mmap.mmap(fid.fileno(), size, access=mmap.ACCESS_READ, offset=offset)
+
+    @property
+    def absolute_address(self):
+        return True
+
+    def close(self):
+        """Takes the ROM off the bus, whose pages hold views of the mapping, and unmaps the file"""
+        self.bus.unregister(self)
+        self._data.close()
+
+
+class BankedMemory(RAM):
+    """A bank_size window onto a larger backing store of size bytes, addressed from 0 at the address it is
+    registered at. select() points the window at another bank by repointing the bus pages, nothing is copied.
+    Snapshots are the RAM pages of the whole store preceded by a one byte page holding the bank"""
+
+    def __init__(self, bus, size, bank_size, data=None, track_dirty=False):
+        if bank_size % PAGE_SIZE or size % bank_size:
+            raise ValueError(f'bank size {bank_size:X} has to be a multiple of {PAGE_SIZE:X} dividing {size:X}')
+        super().__init__(bus, size, data=data, track_dirty=track_dirty)
+        self.bank_size = bank_size
+        self.banks = size // bank_size
+        self.bank = 0
+
+    def __setitem__(self, address, data):
+        self._data[address] = data
+        if self.dirty is not None:
+            self.dirty[address // PAGE_SIZE] = DIRTY_ALL
+
+    @property
+    def size(self):
+        return self.bank_size
+
+    @property
+    def absolute_address(self):
+        return True
+
+    def select(self, bank):
+        """Shows bank through the window. Numbers past the last bank wrap around, as unused select lines would"""
+        bank %= self.banks
+        if bank != self.bank:
+            self.bus.rebase(self, (bank - self.bank) * self.bank_size)
+            self.bank = bank
+
+    def snapshot(self, previous=None):
+        pages = self._pages(previous and previous[1:], previous is not None and previous is self._snapshot)
+        self._snapshot = (bytes((self.bank,)),) + pages
+        return self._snapshot
+
+    def restore(self, state):
+        self.select(state[0][0])
+        super().restore(state[1:])
+        self._snapshot = state
+
+
+class BankSelect(BusDevice):
+    """One byte register switching the bank of a BankedMemory when written, and reading back the bank"""
+
+    def __init__(self, bus, memory):
+        super().__init__(bus)
+        self.memory = memory
+
+    def __getitem__(self, address):
+        return self.memory.bank
+
+    def __setitem__(self, address, data):
+        self.memory.select(data)
+
+    @property
+    def size(self):
+        return 1
+
+    @property
+    def absolute_address(self):
+        return True
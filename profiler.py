@@ -0,0 +1,133 @@
+#! /usr/bin/env python
+# -*- coding: utf-8 -*-
+"""Execution profiler counting opcodes, addresses and subroutine cycles"""
+
+import json
+from array import array
+
+JSR = 0x20
+RTS = 0x60
+
+
+class Profiler:
+    """Cpu hook collecting counts and cycles per opcode and per address, plus the cycles spent in each
+    subroutine from JSR to its RTS, including nested calls. Cycles of an instruction are only known once the
+    next one starts, and cycles spent on interrupts are charged to the instruction they interrupted"""
+    max_depth = 256     # Calls tracked before the oldest are forgotten, for code that never returns
+
+    def __init__(self):
+        self.cpu = None
+        self.opcode_counts = array('Q', bytes(8 * 0x100))
+        self.opcode_cycles = array('Q', bytes(8 * 0x100))
+        self.pc_counts = array('Q', bytes(8 * 0x10000))
+        self.pc_cycles = array('Q', bytes(8 * 0x10000))
+        self.subroutine_calls = array('Q', bytes(8 * 0x10000))
+        self.subroutine_cycles = array('Q', bytes(8 * 0x10000))
+        self._calls = list()    # (subroutine address, cycle stamp of the JSR)
+        self._last_pc = -1
+        self._last_opcode = 0
+        self._last_cycles = 0
+
+    def __call__(self, cpu, pc):
+        now = cpu.total_cycles
+        last = self._last_pc
+        if last >= 0:
+            spent = now - self._last_cycles
+            self.opcode_cycles[self._last_opcode] += spent
+            self.pc_cycles[last] += spent
+            if self._last_opcode == RTS and self._calls:
+                address, start = self._calls.pop()
+                self.subroutine_cycles[address] += now - start
+        read_pages = cpu._read_pages
+        opcode = read_pages[pc >> 8][pc & 0xFF]
+        self.opcode_counts[opcode] += 1
+        self.pc_counts[pc] += 1
+        if opcode == JSR:
+            address = read_pages[(pc + 1) >> 8][(pc + 1) & 0xFF] | read_pages[(pc + 2) >> 8][(pc + 2) & 0xFF] << 8
+            self.subroutine_calls[address] += 1
+            self._calls.append((address, now))
+            if len(self._calls) > self.max_depth:
+                del self._calls[0]
+        self._last_pc = pc
+        self._last_opcode = opcode
+        self._last_cycles = now
+
+    @property
+    def enabled(self):
+        return self.cpu is not None
+
+    def enable(self, cpu):
+        """Starts profiling cpu, keeping the counts gathered so far"""
+        self.cpu = cpu
+        self._last_pc = -1
+        self._calls = list()
+        cpu.add_hook(self)
+
+    def disable(self):
+        """Stops profiling, charging the last instruction with the cycles it took"""
+        if self.cpu is not None:
+            if self._last_pc >= 0:
+                spent = self.cpu.total_cycles - self._last_cycles
+                self.opcode_cycles[self._last_opcode] += spent
+                self.pc_cycles[self._last_pc] += spent
+                self._last_pc = -1
+            self.cpu.remove_hook(self)
+            self.cpu = None
+
+    def clear(self):
+        for counters in (self.opcode_counts, self.opcode_cycles, self.pc_counts, self.pc_cycles,
+                         self.subroutine_calls, self.subroutine_cycles):
+            counters[:] = array('Q', bytes(8 * len(counters)))
+        self._calls = list()
+        self._last_pc = -1
+
+    def mode_counts(self, matrix):
+        """Instructions and cycles per addressing mode, from the opcode counters and a cpu's opcode matrix"""
+        out = dict()
+        for opcode, (_, mode, _) in enumerate(matrix):
+            count, cycles = out.get(mode, (0, 0))
+            out[mode] = (count + self.opcode_counts[opcode], cycles + self.opcode_cycles[opcode])
+        return out
+
+    @staticmethod
+    def _top(counts, cycles, number):
+        used = [index for index in range(len(counts)) if counts[index]]
+        used.sort(key=lambda index: cycles[index], reverse=True)
+        return [(index, counts[index], cycles[index]) for index in used[:number]]
+
+    def summary(self, matrix, number=20):
+        """The number heaviest opcodes, addresses and subroutines by cycles, and all modes, as plain data"""
+        return {
+            'opcodes': [dict(opcode=opcode, operation=matrix[opcode][0], mode=matrix[opcode][1], count=count,
+                             cycles=cycles)
+                        for opcode, count, cycles in self._top(self.opcode_counts, self.opcode_cycles, number)],
+            'modes': [dict(mode=mode, count=count, cycles=cycles)
+                      for mode, (count, cycles) in sorted(self.mode_counts(matrix).items(),
+                                                          key=lambda item: item[1][1], reverse=True) if count],
+            'addresses': [dict(pc=pc, count=count, cycles=cycles)
+                          for pc, count, cycles in self._top(self.pc_counts, self.pc_cycles, number)],
+            'subroutines': [dict(address=address, calls=calls, cycles=cycles)
+                            for address, calls, cycles in self._top(self.subroutine_calls, self.subroutine_cycles,
+                                                                    number)],
+        }
+
+    def report(self, matrix, number=20):
+        """Readable text version of summary()"""
+        summary = self.summary(matrix, number)
+        lines = ['Opcodes:']
+        lines += [f'  {item["opcode"]:02X} {item["operation"]:6s} {item["mode"]:20s} {item["count"]:12d} '
+                  f'{item["cycles"]:14d}' for item in summary['opcodes']]
+        lines.append('Addressing modes:')
+        lines += [f'  {item["mode"]:27s} {item["count"]:12d} {item["cycles"]:14d}' for item in summary['modes']]
+        lines.append('Addresses:')
+        lines += [f'  {item["pc"]:04X} {item["count"]:34d} {item["cycles"]:14d}' for item in summary['addresses']]
+        lines.append('Subroutines:')
+        lines += [f'  {item["address"]:04X} {item["calls"]:34d} {item["cycles"]:14d}'
+                  for item in summary['subroutines']]
+        return '\n'.join(lines)
+
+    def export(self, file, matrix):
+        """Writes the complete counters as JSON, zero entries left out"""
+        data = self.summary(matrix, number=0x10000)
+        with open(file, 'w') as fid:
+            json.dump(data, fid, indent=1)
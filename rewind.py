@@ -0,0 +1,112 @@
+#! /usr/bin/env python
+# -*- coding: utf-8 -*-
+"""Rewinding through execution by way of periodic checkpoints stored as deltas"""
+
+from collections import deque
+
+from cpu6502 import Snapshot
+
+
+def xor(first, second):
+    return (int.from_bytes(first, 'little') ^ int.from_bytes(second, 'little')).to_bytes(len(first), 'little')
+
+
+def rle_encode(data):
+    """Packs data as (zero run, literal count, literals...) groups, each count at most 255"""
+    out = bytearray()
+    index = 0
+    length = len(data)
+    while index < length:
+        zeros = 0
+        while index < length and data[index] == 0 and zeros < 255:
+            zeros += 1
+            index += 1
+        start = index
+        while index < length and data[index] != 0 and index - start < 255:
+            index += 1
+        out += bytes((zeros, index - start))
+        out += data[start:index]
+    return bytes(out)
+
+
+def rle_decode(data, size):
+    out = bytearray(size)
+    index = 0
+    position = 0
+    while position < len(data):
+        zeros, count = data[position], data[position + 1]
+        index += zeros
+        out[index:index + count] = data[position + 2:position + 2 + count]
+        index += count
+        position += 2 + count
+    return bytes(out)
+
+
+class Rewind:
+    """Takes a checkpoint every interval cycles through the bus event queue. Only the newest checkpoint is
+    kept whole; for each older one the ring holds its registers and the XOR of every memory page that
+    changed before the next checkpoint, run length encoded. Devices whose state is not a tuple of pages
+    are stored whole"""
+
+    def __init__(self, cpu, interval=16667, capacity=3600):
+        self.cpu = cpu
+        self.interval = interval
+        self.entries = deque(maxlen=capacity)   # (registers, device deltas), oldest first
+        self.latest = None
+        self._event = None
+
+    def start(self):
+        self.checkpoint()
+
+    def stop(self):
+        if self._event is not None:
+            self.cpu.bus.cancel(self._event)
+            self._event = None
+
+    def __len__(self):
+        """Checkpoints that can be rewound to, the newest included"""
+        return len(self.entries) + (self.latest is not None)
+
+    def checkpoint(self, _=None):
+        snapshot = self.cpu.snapshot(self.latest)
+        if self.latest is not None:
+            deltas = tuple(self._delta(old, new) for old, new in zip(self.latest.devices, snapshot.devices))
+            self.entries.append((self.latest.registers, deltas))
+        self.latest = snapshot
+        self.stop()
+        self._event = self.cpu.bus.schedule(self.interval, self.checkpoint)
+
+    @staticmethod
+    def _delta(old, new):
+        if not isinstance(old, tuple) or not isinstance(new, tuple) or len(old) != len(new):
+            return False, old
+        # Unchanged pages are shared between snapshots, so identity finds the changed ones
+        return True, tuple((number, rle_encode(xor(old_page, new_page)))
+                           for number, (old_page, new_page) in enumerate(zip(old, new)) if old_page is not new_page)
+
+    @staticmethod
+    def _undo(state, delta):
+        is_delta, value = delta
+        if not is_delta:
+            return value
+        pages = list(state)
+        for number, packed in value:
+            pages[number] = xor(pages[number], rle_decode(packed, len(pages[number])))
+        return tuple(pages)
+
+    def rewind(self, steps=1):
+        """Restores the checkpoint steps before the newest one, forgetting everything after it. Recording
+        carries on from there. Returns the total_cycles of the restored state"""
+        if not 0 <= steps < len(self):
+            raise IndexError(steps)
+        devices = self.latest.devices
+        registers = self.latest.registers
+        for _ in range(steps):
+            registers, deltas = self.entries.pop()
+            devices = tuple(self._undo(state, delta) for state, delta in zip(devices, deltas))
+        self.latest = Snapshot(registers, devices)
+        self.cpu.restore(self.latest)
+        if self._event is not None:
+            self.stop()
+            self._event = self.cpu.bus.schedule(self.interval, self.checkpoint)
+        return self.cpu.total_cycles
@@ -0,0 +1,129 @@
+#! /usr/bin/env python
+# -*- coding: utf-8 -*-
+"""Command line entry point. Runs an image headless unless --gui is given, so GTK is only imported then"""
+
+import argparse
+import sys
+
+import bus
+import cpu6502
+import memory
+import profiler
+import tracer
+
+
+def number(text):
+    """Parses decimal, 0x and $ prefixed numbers"""
+    if text.startswith('$'):
+        return int(text[1:], 16)
+    return int(text, 0)
+
+
+def build_machine(args):
+    b = bus.Bus(open_bus=args.open_bus)
+    ram = memory.RAM(b, 0x10000)
+    if args.rom is not None:
+        b.register(memory.MappedROM(b, args.image), args.rom)   # Registered first so it takes priority
+    else:
+        ram.load_from_file(args.image, args.load_address)
+    b.register(ram, 0)
+    cpu = cpu6502.Cpu6502(b, zero_page_bug=not args.no_zero_page_bug, lazy_flags=args.lazy_flags,
+                          compile_blocks=args.compile_blocks, skip_idle=args.skip_idle)
+    cpu.reset()
+    if args.pc is not None:
+        cpu.PC = args.pc
+    return cpu
+
+
+def trap_detector():
+    """Predicate for run_until that is true once an instruction jumps to itself, e.g. JMP * or BNE *"""
+    last_pc = [None]
+
+    def trapped(cpu):
+        hit = cpu.PC == last_pc[0]
+        last_pc[0] = cpu.PC
+        return hit
+    return trapped
+
+
+def run(cpu, args):
+    predicate = trap_detector() if args.until_trap else None
+    if args.until_pc is None and predicate is None:
+        cpu.run(args.cycles)
+    else:
+        cycle_count = None if args.cycles is None else cpu.total_cycles + args.cycles
+        cpu.run_until(predicate, pc=args.until_pc, cycle_count=cycle_count)
+
+
+def registers(cpu):
+    return (f'PC={cpu.PC:04X} A={cpu.A:02X} X={cpu.X:02X} Y={cpu.Y:02X} S={cpu.S:02X} P={cpu.P:08b} '
+            f'cycles={cpu.total_cycles:d}')
+
+
+def dump(cpu, args):
+    if args.dump_registers:
+        with open(args.dump_registers, 'w') as fid:
+            fid.write(registers(cpu) + '\n')
+    for start, stop, file in args.dump_memory or []:
+        with open(file, 'wb') as fid:
+            fid.write(bytes(cpu.bus[address] for address in range(number(start), number(stop))))
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='6502 emulator')
+    parser.add_argument('image', help='binary image to load')
+    parser.add_argument('--load-address', type=number, default=0, help='where the image is loaded into RAM')
+    parser.add_argument('--rom', type=number, metavar='ADDRESS', help='map the image as ROM at ADDRESS instead')
+    parser.add_argument('--open-bus', type=number, metavar='VALUE', help='read VALUE where nothing is mapped')
+    parser.add_argument('--pc', type=number, help='start here instead of at the reset vector')
+    parser.add_argument('--cycles', type=number, help='cycles to run for')
+    parser.add_argument('--until-pc', type=number, metavar='ADDRESS', help='stop once PC reaches ADDRESS')
+    parser.add_argument('--until-trap', action='store_true', help='stop at an instruction that jumps to itself')
+    parser.add_argument('--dump-registers', metavar='FILE')
+    parser.add_argument('--dump-memory', nargs=3, action='append', metavar=('START', 'STOP', 'FILE'))
+    parser.add_argument('--width', type=int, default=256, help='GUI screen width')
+    parser.add_argument('--height', type=int, default=240, help='GUI screen height')
+    parser.add_argument('--scale', type=int, default=1, help='GUI screen scale')
+    parser.add_argument('--no-zero-page-bug', action='store_true')
+    parser.add_argument('--lazy-flags', action='store_true')
+    parser.add_argument('--compile-blocks', action='store_true')
+    parser.add_argument('--skip-idle', action='store_true')
+    parser.add_argument('--trace', metavar='FILE', help='write a binary record of every instruction to FILE')
+    parser.add_argument('--trace-compression', choices=('gzip', 'bz2', 'lzma'))
+    parser.add_argument('--profile', metavar='FILE', help='profile the run, print a report and export it to FILE')
+    parser.add_argument('--gui', action='store_true', help='open the GTK window instead of running headless')
+    parser.add_argument('--clock-rate', type=number, help='GUI clock rate for the emulation thread')
+    parser.add_argument('--history', type=number, default=0, metavar='DEPTH',
+                        help='show the last DEPTH instructions in the GUI; turns off --compile-blocks and --skip-idle')
+    args = parser.parse_args(argv)
+
+    cpu = build_machine(args)
+    if args.gui:
+        import emulator
+        emulator.Screen(cpu, args.width, args.height, args.scale, title='Emulator', clock_rate=args.clock_rate,
+                        history_depth=args.history)
+        emulator.Gtk.main()
+        return 0
+    if args.cycles is None and args.until_pc is None and not args.until_trap:
+        parser.error('give --cycles, --until-pc or --until-trap to say when to stop')
+    profile = profiler.Profiler()
+    if args.profile:
+        profile.enable(cpu)
+    if args.trace:
+        with tracer.Tracer(args.trace, args.trace_compression) as trace:
+            cpu.add_hook(trace)
+            run(cpu, args)
+            cpu.remove_hook(trace)
+    else:
+        run(cpu, args)
+    profile.disable()
+    if args.profile:
+        print(profile.report(cpu.matrix))
+        profile.export(args.profile, cpu.matrix)
+    dump(cpu, args)
+    print(registers(cpu))
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,109 @@
+#! /usr/bin/env python
+# -*- coding: utf-8 -*-
+"""Binary execution traces, streamed to disk by a cpu hook and read back as records"""
+
+import bz2
+import gzip
+import lzma
+import struct
+from collections import namedtuple
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+MAGIC = b'6502TRC1'
+RECORD = struct.Struct('<HBBBBBBBBQ')   # PC, opcode, two operand bytes, A, X, Y, S, P, cycle
+TraceRecord = namedtuple('TraceRecord', 'pc opcode operand1 operand2 a x y s p cycle')
+
+_OPENERS = {None: open, 'gzip': gzip.open, 'bz2': bz2.open, 'lzma': lzma.open}
+
+# Leading bytes of each compressed format, to pick a decompressor when reading
+_SIGNATURES = ((b'\x1f\x8b', 'gzip'), (b'BZh', 'bz2'), (b'\xfd7zXZ\x00', 'lzma'))
+
+
+class Tracer:
+    """Writes one fixed width record per executed instruction. Install it with cpu.add_hook(tracer), which is
+    the only cost: without the hook the cpu runs its normal loop. Bytes are only read from pages that are
+    plain memory views, so tracing never reads a device; opcodes and operands elsewhere are stored as 0, as
+    are operand bytes the instruction does not have. compression is None, 'gzip', 'bz2' or 'lzma'"""
+
+    def __init__(self, file, compression=None, buffer_records=8192):
+        self._file = _OPENERS[compression](file, 'wb')
+        self._file.write(MAGIC)
+        self._buffer = bytearray(RECORD.size * buffer_records)
+        self._offset = 0
+        self.records = 0
+        self._matrix = None
+        self._lengths = None    # Operand bytes per opcode of the matrix last traced
+
+    def __call__(self, cpu, pc):
+        if cpu.matrix is not self._matrix:
+            self._matrix = cpu.matrix
+            self._lengths = bytes(cpu.address_lengths(mode) for _, mode, _ in cpu.matrix)
+        read_pages = cpu._read_pages
+        opcode = self._read(read_pages, pc)
+        length = self._lengths[opcode]
+        operand1 = self._read(read_pages, pc + 1) if length else 0
+        operand2 = self._read(read_pages, pc + 2) if length > 1 else 0
+        RECORD.pack_into(self._buffer, self._offset, pc, opcode, operand1, operand2,
+                         cpu.A, cpu.X, cpu.Y, cpu.S, cpu.P, cpu.total_cycles)
+        self._offset += RECORD.size
+        self.records += 1
+        if self._offset == len(self._buffer):
+            self.flush()
+
+    @staticmethod
+    def _read(read_pages, address):
+        if address > 0xFFFF:
+            return 0
+        page = read_pages[address >> 8]
+        return page[address & 0xFF] if type(page) is memoryview else 0
+
+    def flush(self):
+        self._file.write(memoryview(self._buffer)[:self._offset])
+        self._offset = 0
+
+    def close(self):
+        self.flush()
+        self._file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *_):
+        self.close()
+
+
+def _open(file):
+    with open(file, 'rb') as fid:
+        start = fid.read(len(MAGIC))
+    compression = next((name for signature, name in _SIGNATURES if start.startswith(signature)), None)
+    fid = _OPENERS[compression](file, 'rb')
+    if fid.read(len(MAGIC)) != MAGIC:
+        fid.close()
+        raise ValueError(f'{file} is not an execution trace')
+    return fid
+
+
+def read_trace(file, chunk_records=8192):
+    """Yields the TraceRecords of a trace file, compressed or not"""
+    with _open(file) as fid:
+        while True:
+            data = fid.read(RECORD.size * chunk_records)
+            if not data:
+                return
+            for record in RECORD.iter_unpack(data[:len(data) - len(data) % RECORD.size]):
+                yield TraceRecord(*record)
+
+
+def read_trace_array(file):
+    """Reads a whole trace file into a NumPy structured array with the TraceRecord field names"""
+    if numpy is None:
+        raise ImportError('read_trace_array needs NumPy')
+    dtype = numpy.dtype([('pc', '<u2'), ('opcode', 'u1'), ('operand1', 'u1'), ('operand2', 'u1'), ('a', 'u1'),
+                         ('x', 'u1'), ('y', 'u1'), ('s', 'u1'), ('p', 'u1'), ('cycle', '<u8')])
+    with _open(file) as fid:
+        data = fid.read()
+    return numpy.frombuffer(data[:len(data) - len(data) % RECORD.size], dtype)
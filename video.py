@@ -0,0 +1,163 @@
+#! /usr/bin/env python
+# -*- coding: utf-8 -*-
+"""Frame buffer and colour handling, usable without a GUI"""
+
+from collections import namedtuple
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+
+class Color:
+    """Holds color information"""
+
+    def __init__(self, red=255, green=255, blue=255):
+        self.red = red
+        self.green = green
+        self.blue = blue
+
+    def __str__(self):
+        return f'{self.red:02X}{self.green:02X}{self.blue:02X}'
+
+    def __int__(self):
+        return (self.red << 16) + (self.green << 8) + self.blue
+
+    def __iter__(self):
+        return (x for x in [self.red, self.green, self.blue])
+
+    def invert(self):
+        self.red = self.red ^ 0xFF
+        self.green = self.green ^ 0xFF
+        self.blue = self.blue ^ 0xFF
+
+
+# Registers copied out of a running cpu, duck-typed for the widgets that would otherwise read the cpu
+CpuState = namedtuple('CpuState', 'PC A X Y S P total_cycles')
+
+
+def union(first, second):
+    """Smallest (x, y, width, height) rectangle covering both, either of which may be None"""
+    if first is None:
+        return second
+    if second is None:
+        return first
+    left, top = min(first[0], second[0]), min(first[1], second[1])
+    right = max(first[0] + first[2], second[0] + second[2])
+    bottom = max(first[1] + first[3], second[1] + second[3])
+    return left, top, right - left, bottom - top
+
+
+class VideoBuffer:
+    """Video Buffer Class, holding packed RGB rows that a GdkPixbuf can use as they are. blit() and upload()
+    use NumPy when it is installed. The pure Python fallback takes a few milliseconds for a 256x240 frame at
+    scale 2, a sizeable share of a 60 Hz frame"""
+    def __init__(self, width=256, height=240, scale=1):
+        self.width = width
+        self.height = height
+        self.scale = scale
+        self.data = bytearray(3 * self.overall_size)
+        # (rows, columns, 3) view sharing data, when NumPy is available
+        self.pixels = numpy.frombuffer(self.data, numpy.uint8).reshape(self.overall_height, self.overall_width, 3) \
+            if numpy else None
+        self.dirty = None   # (x, y, width, height) in buffer pixels changed since the last take_dirty()
+
+    def fill(self, color):
+        self.data[:] = bytes(color) * self.overall_size
+        self.damage(0, 0, self.width, self.height)
+
+    def damage(self, x, y, width, height):
+        """Marks a rectangle of logical pixels as changed"""
+        scale = self.scale
+        self.dirty = union(self.dirty, (x * scale, y * scale, width * scale, height * scale))
+
+    def take_dirty(self):
+        """Returns the changed rectangle in buffer pixels, or None if nothing changed, and marks all clean"""
+        dirty, self.dirty = self.dirty, None
+        return dirty
+
+    def __getitem__(self, pos):
+        x, y = pos
+        assert(x < self.width)
+        assert(y < self.height)
+        index = self.scale * 3 * (y * self.overall_width + x)
+        return Color(self.data[index], self.data[index+1], self.data[index+2])
+
+    def __setitem__(self, pos, color):
+        x, y = pos
+        assert(x < self.width)
+        assert(y < self.height)
+        self.damage(x, y, 1, 1)
+        index = self.scale * 3 * (y * self.overall_width + x)
+        pixels = bytes(color) * self.scale
+        for _ in range(self.scale):
+            self.data[index:index + len(pixels)] = pixels
+            index += self.rowstride
+
+    def pixel(self, x, y):
+        """Color of a logical pixel as 0xRRGGBB, without creating a Color"""
+        index = self.scale * 3 * (y * self.overall_width + x)
+        return self.data[index] << 16 | self.data[index + 1] << 8 | self.data[index + 2]
+
+    def blit(self, rect, buffer):
+        """Copies packed RGB pixels at logical resolution into rect = (x, y, width, height), scaling them up"""
+        x, y, width, height = rect
+        assert(0 <= x and x + width <= self.width)
+        assert(0 <= y and y + height <= self.height)
+        self.damage(x, y, width, height)
+        scale = self.scale
+        if self.pixels is not None:
+            source = numpy.frombuffer(buffer, numpy.uint8, 3 * width * height).reshape(height, width, 3)
+            if scale > 1:
+                source = source.repeat(scale, axis=0).repeat(scale, axis=1)
+            self.pixels[y * scale:(y + height) * scale, x * scale:(x + width) * scale] = source
+            return
+        source = memoryview(buffer)[:3 * width * height]
+        if scale > 1:
+            # Widen every pixel with one strided copy per channel and repeat
+            pixels = bytes(source)
+            wide = bytearray(len(pixels) * scale)
+            for copy in range(scale):
+                for channel in range(3):
+                    wide[3 * copy + channel::3 * scale] = pixels[channel::3]
+            source = memoryview(wide)
+        row_length = 3 * width * scale
+        index = y * scale * self.rowstride + 3 * scale * x
+        for line in range(0, len(source), row_length):
+            row = source[line:line + row_length]
+            for _ in range(scale):
+                self.data[index:index + row_length] = row
+                index += self.rowstride
+
+    def upload(self, indices, palette):
+        """Replaces the whole frame from one palette index per logical pixel. palette holds Colors"""
+        assert(len(indices) == self.width * self.height)
+        if self.pixels is not None:
+            colors = numpy.array([tuple(color) for color in palette], numpy.uint8)
+            buffer = colors[numpy.frombuffer(indices, numpy.uint8)]
+        else:
+            # One translate per channel, interleaved with strided copies
+            colors = [tuple(color) for color in palette]
+            indices = bytes(indices)
+            buffer = bytearray(3 * len(indices))
+            for channel in range(3):
+                table = bytes(colors[index][channel] if index < len(colors) else 0 for index in range(256))
+                buffer[channel::3] = indices.translate(table)
+        self.blit((0, 0, self.width, self.height), buffer)
+
+    @property
+    def overall_width(self):
+        return self.width * self.scale
+
+    @property
+    def overall_height(self):
+        return self.height * self.scale
+
+    @property
+    def overall_size(self):
+        return self.overall_width * self.overall_height
+
+    @property
+    def rowstride(self):
+        return 3 * self.overall_width